@@ -1,19 +1,51 @@
-from flask import Flask, jsonify, request, session
-from flask_pymongo import PyMongo
+from flask import Flask, jsonify, request, session, stream_with_context
 from flask_cors import CORS
 from bson import ObjectId
+from pymongo import ReturnDocument
 from datetime import datetime, timedelta
 import os
 import re  # Add this import for regex validation
 from dotenv import load_dotenv
-from models import User, Shop, Product, Wishlist, Order, Feedback
 
+# Before the local imports: they read their settings from the environment at import time
 load_dotenv()
+
+from models import User, Shop, Product, Wishlist, Feedback
+from db import Mongo
+from auth import (load_current_user, invalidate_user, clean_mobile, login_user,
+                  current_user_id, token_claims, uses_token)
+from tokens import issue_token, revoke_token
+from cache import LoadingCache
+from indexes import ensure_indexes
+from ids import id_filter, index_by_id
+import migrations
+import versions
+from conditional import conditional
+from pagination import page_params, paginate
+from orders import order_history, order_count, SUMMARY_PROJECTION
+from checkout import run_checkout, shop_order, products_order, request_fingerprint
+from wishlist import wishlist_products, product_shop_id, add_item, update_quantities, remove_items
+from streaming import iter_json_array, iter_json_chunks, STREAM_BATCH_SIZE
+from json_provider import ORJSONProvider
+import cart_counts
+import compression
+import logs
+import metrics
+import profiling
+from health import ReadinessMonitor
  
 app = Flask(__name__)
+# Encodes ObjectId and datetime fields wherever they are in a document
+app.json = ORJSONProvider(app)
+compression.init_app(app)
 app.secret_key = os.getenv('SECRET_KEY')
 app.config["MONGO_URI"] = os.getenv('MONGO_URI')
-mongo = PyMongo(app)
+# The client itself is only created on first use, inside each worker
+mongo = Mongo(app.config["MONGO_URI"])
+log = logs.get_logger('api')
+# Registers the command listener before the client exists, and times every request
+metrics.init_app(app, mongo)
+profiling.init_app(app, mongo)
 
 # Configure session for longer duration
 
@@ -27,133 +59,163 @@ app.config.update(
     PERMANENT_SESSION_LIFETIME=timedelta(days=30)
 )
 
+CORS_ORIGINS = [
+    "https://locallys.in",
+    "https://www.locallys.in",
+]
+CORS_HEADERS = ["Content-Type", "Authorization", "Idempotency-Key"]
+CORS_METHODS = ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
+
 CORS(app, 
      supports_credentials=True, 
-     origins=[
-         "https://locallys.in",
-         "https://www.locallys.in", 
-     ],
-     allow_headers=["Content-Type", "Authorization"],
-     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
-
-# Helper function to serialize ObjectId
-def serialize_doc(doc):
-    if doc is None:
-        return None
-    if '_id' in doc:
-        doc['_id'] = str(doc['_id'])
-    return doc
+     origins=CORS_ORIGINS,
+     allow_headers=CORS_HEADERS,
+     methods=CORS_METHODS)
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create the indexes listed in indexes.py"""
+    for collection, name, error in ensure_indexes(mongo.db):
+        print(f"⚠️ Could not create index {name} on {collection}: {error}")
+
+# Per-worker cache of encoded shop and product listings. Keys embed the
+# version stamps they were built from, so a bump in any worker retires them.
+catalogue_cache = LoadingCache(
+    max_bytes=int(os.getenv('CATALOGUE_CACHE_BYTES', 32 * 1024 * 1024)),
+    ttl=float(os.getenv('CATALOGUE_CACHE_TTL', 60)),
+    stale_ttl=float(os.getenv('CATALOGUE_CACHE_STALE_TTL', 30))
+)
+versions.on_bump(catalogue_cache.invalidate)
+
+def catalogue_key(*stamp_keys):
+    """Cache key for the current request built from its version stamps"""
+    stamps = versions.get_versions(mongo.db, stamp_keys)
+    key = ','.join(f'{k}@{stamps[k][0]}' for k in stamp_keys)
+    return f"{key}?{request.query_string.decode()}"
+
+def json_body(data):
+    return app.json.dumpb(data)
+
+def json_response(body, status=200):
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def stream_response(value):
+    """Chunked JSON response; cursors in value are streamed as arrays"""
+    chunks = iter_json_chunks(value, app.json.dumpb)
+    return app.response_class(stream_with_context(chunks), mimetype='application/json')
+
+def idempotency():
+    """(Idempotency-Key header, request fingerprint) for run_checkout"""
+    return request.headers.get('Idempotency-Key'), request_fingerprint(request.path, request.get_data())
+
+def stream_requested():
+    return request.args.get('stream') in ('1', 'true')
+
+# Keyset orders for paginated listings
+ID_ORDER = [('_id', 1)]
+NEWEST_FIRST = [('created_at', -1), ('_id', -1)]
 
 # ======================
 # IMPROVED AUTH ENDPOINTS
 # ======================
+# Probes are polled constantly (platform checks, Wishlist.js), so they skip
+# the session hooks below and never touch Mongo on the request path
+PROBE_ENDPOINTS = {'health_check', 'readiness_check'}
+HEALTH_BODY = json_body({'status': 'healthy', 'message': 'API is running'})
+readiness = ReadinessMonitor(mongo)
+
 @app.route('/api/health')
 def health_check():
-    return jsonify({
-        'status': 'healthy', 
-        'message': 'API is running',
-        'timestamp': datetime.utcnow().isoformat(),
-        'routes': [str(rule) for rule in app.url_map.iter_rules()]
-    })
+    """Liveness: the worker is up and serving requests"""
+    return json_response(HEALTH_BODY)
+
+@app.route('/api/ready')
+def readiness_check():
+    """Readiness: the last background Mongo ping succeeded"""
+    status = readiness.status()
+    return jsonify(status), 200 if status['ready'] else 503
 @app.route('/api/auth/mobile', methods=['POST'])
 def mobile_auth():
     """Mobile authentication endpoint - fixed version"""
     try:
-        print("🔍 [AUTH] Starting mobile authentication...")
-        
         # Check if request has JSON data
         if not request.is_json:
             return jsonify({'error': 'Missing JSON in request'}), 400
             
         data = request.get_json()
-        print(f"🔍 [AUTH] Received data: {data}")
+        if logs.DEBUG:
+            log.debug('auth.request', 'Received mobile auth request', data=data)
         
         if not data:
             return jsonify({'error': 'No data provided'}), 400
             
         mobile = data.get('mobile')
-        print(f"🔍 [AUTH] Mobile received: {mobile}")
         
         # Input validation
         if not mobile:
             return jsonify({'error': 'Mobile number is required'}), 400
         
         # Clean and validate mobile number
-        mobile_clean = ''.join(filter(str.isdigit, str(mobile)))
+        mobile_clean = clean_mobile(mobile)
         
         if len(mobile_clean) != 10:
             return jsonify({'error': 'Invalid mobile number. Must be 10 digits.'}), 400
 
-        # Find or create user WITHOUT using the User class
-        user = mongo.db.users.find_one({'mobile': mobile_clean})
-        
-        if not user:
-            print(f"🆕 [AUTH] Creating new user for mobile: {mobile_clean}")
-            # Create new user directly without User class
-            user_data = {
-                'mobile': mobile_clean,
-                'createdAt': datetime.utcnow(),
-                'lastLogin': datetime.utcnow()
-            }
-            result = mongo.db.users.insert_one(user_data)
-            user_id = result.inserted_id
-            user = mongo.db.users.find_one({'_id': user_id})
-            is_new = True
-            print(f"✅ [AUTH] New user created with ID: {user_id}")
-        else:
-            print(f"✅ [AUTH] Existing user found: {user['_id']}")
-            # Update last login for existing user
-            mongo.db.users.update_one(
-                {'_id': user['_id']},
-                {'$set': {'lastLogin': datetime.utcnow()}}
-            )
-            is_new = False
+        # Find or create the user and record the login in one round trip
+        user, is_new = login_user(mongo.db, mobile_clean)
+        if is_new:
+            log.info('auth.new_user', 'New user created', user_id=str(user['_id']))
 
-        # Create session
-        session.clear()  # Clear any existing session first
-        session['user_id'] = str(user['_id'])
-        session['mobile'] = user['mobile']
-        session.permanent = True
-        
-        print(f"✅ [AUTH] Authentication successful for: {user['mobile']}")
-        
-        return jsonify({
+        body = {
             'success': True,
             'user': {
                 'id': str(user['_id']),
                 'mobile': user['mobile'],
                 'isNew': is_new
             }
-        })
+        }
+
+        if data.get('mode') == 'token':
+            # Stateless clients get a bearer token (and come back here to refresh it)
+            token, expires_in = issue_token(user)
+            body.update({'access_token': token, 'token_type': 'Bearer', 'expires_in': expires_in})
+        else:
+            # Create session
+            session.clear()  # Clear any existing session first
+            session['user_id'] = str(user['_id'])
+            session['mobile'] = user['mobile']
+            session.permanent = True
+        
+        log.info('auth.login', 'Authentication successful', user_id=str(user['_id']))
+        
+        return jsonify(body)
 
     except Exception as error:
-        print(f'❌ [AUTH] Unexpected error: {error}')
-        import traceback
-        traceback.print_exc()
+        log.error('auth.error', 'Mobile authentication failed', exc_info=True)
         return jsonify({'error': 'Authentication failed'}), 500
 @app.route('/api/check-session', methods=['GET'])
 def check_session():
     """Fast session check endpoint"""
     try:
-        print(f"🔍 Checking session - user_id in session: {'user_id' in session}")
-        print(f"🔍 Session contents: {dict(session)}")
+        if logs.DEBUG:
+            log.debug('session.check', 'Checking session', session=dict(session))
         
-        if 'user_id' not in session:
-            print("❌ No user_id in session")
+        claims = token_claims()
+        if claims:
+            # The signed token is the identity; no lookup needed
+            return jsonify({'user': {'id': claims['sub'], 'mobile': claims['mobile']}})
+
+        if not current_user_id():
             return jsonify({'user': None})
 
-        # Only fetch essential user data
-        user = mongo.db.users.find_one(
-            {'_id': ObjectId(session['user_id'])},
-            {'mobile': 1, 'lastLogin': 1}
-        )
+        # Reuses the user already loaded for this request
+        user = load_current_user(mongo.db)
 
         if not user:
-            print("❌ User not found in database")
+            log.info('session.unknown_user', 'Session user not found', user_id=current_user_id())
             session.clear()
             return jsonify({'user': None})
 
-        print(f"✅ Session valid for user: {user['mobile']}")
         return jsonify({
             'user': {
                 'id': str(user['_id']),
@@ -162,7 +224,7 @@ def check_session():
         })
 
     except Exception as error:
-        print(f'Session check error: {error}')
+        log.error('session.error', 'Session check failed', exc_info=True)
         return jsonify({'user': None})
 
 @app.route('/api/check-user', methods=['POST'])
@@ -183,7 +245,7 @@ def check_user():
         })
 
     except Exception as e:
-        print(f"User check error: {e}")
+        log.error('auth.error', 'User check error', exc_info=True)
         return jsonify({'error': 'User check failed'}), 500
 
 @app.route('/api/login', methods=['POST'])
@@ -200,24 +262,9 @@ def login():
         if not mobile:
             return jsonify({'error': 'Mobile number is required'}), 400
 
-        # Clean mobile number
-        mobile_clean = ''.join(filter(str.isdigit, str(mobile)))
-        
-        # Find existing user
-        user = mongo.db.users.find_one({'mobile': mobile_clean})
-
-        if not user:
-            # Create new user directly without User class
-            user_data = {
-                'mobile': mobile_clean,
-                'createdAt': datetime.utcnow(),
-                'lastLogin': datetime.utcnow()
-            }
-            result = mongo.db.users.insert_one(user_data)
-            user = mongo.db.users.find_one({'_id': result.inserted_id})
-            user_message = 'New account created'
-        else:
-            user_message = 'Welcome back'
+        # Same find-or-create as mobile_auth
+        user, is_new = login_user(mongo.db, clean_mobile(mobile))
+        user_message = 'New account created' if is_new else 'Welcome back'
 
         # Set session data
         session['user_id'] = str(user['_id'])
@@ -226,14 +273,14 @@ def login():
 
         response = jsonify({
             'message': 'Login successful',
-            'user': serialize_doc(user),
+            'user': user,
             'userMessage': user_message
         })
         
         return response
 
     except Exception as e:
-        print(f"Login error: {e}")
+        log.error('auth.error', 'Login error', exc_info=True)
         session.clear()
         return jsonify({'error': 'Login failed'}), 500
      
@@ -241,10 +288,19 @@ def login():
 def logout():
     """Clear session on logout with COMPLETE cookie cleanup"""
     try:
-        user_id = session.get('user_id')
-        print(f"🔄 Logging out user: {user_id}")
+        user_id = current_user_id()
+
+        if uses_token():
+            # Token clients have no cookies to clean up; just revoke the token
+            claims = token_claims()
+            if claims:
+                revoke_token(claims)
+                invalidate_user(user_id)
+            log.info('auth.logout', 'Token revoked', user_id=user_id)
+            return jsonify({'success': True, 'message': 'Logged out successfully'})
         
         # COMPLETELY clear the session
+        invalidate_user(user_id)
         session.clear()
         
         response = jsonify({
@@ -269,11 +325,11 @@ def logout():
                     samesite='Lax'
                 )
         
-        print(f"✅ Session completely cleared for user: {user_id}")
+        log.info('auth.logout', 'Session cleared', user_id=user_id)
         return response
         
     except Exception as e:
-        print(f"❌ Logout error: {e}")
+        log.error('auth.error', 'Logout error', exc_info=True)
         return jsonify({
             'success': False,
             'error': 'Logout failed'
@@ -282,7 +338,15 @@ def logout():
 def force_logout():
     """Force logout by clearing everything"""
     try:
+        if uses_token():
+            claims = token_claims()
+            if claims:
+                revoke_token(claims)
+                invalidate_user(claims['sub'])
+            return jsonify({'success': True, 'message': 'Forced logout successful'})
+
         # Clear session
+        invalidate_user(session.get('user_id'))
         session.clear()
         
         response = jsonify({
@@ -298,7 +362,7 @@ def force_logout():
         
         return response
     except Exception as e:
-        print(f"Force logout error: {e}")
+        log.error('auth.error', 'Force logout error', exc_info=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # ALL YOUR EXISTING ROUTES BELOW (UNCHANGED)
@@ -308,74 +372,82 @@ def home():
 
 @app.route('/api/clear-cart', methods=['POST'])
 def clear_cart():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
         # Delete all wishlist items for this user
-        result = mongo.db.wishlist.delete_many({'user_id': ObjectId(user_id)})
+        deleted_count, _ = remove_items(mongo.db, ObjectId(user_id))
         return jsonify({
             'message': 'Cart cleared successfully',
-            'deleted_count': result.deleted_count
+            'deleted_count': deleted_count
         })
     except Exception as e:
-        print(f"Error clearing cart: {e}")
+        log.error('wishlist.error', 'Error clearing cart', exc_info=True)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/shops', methods=['GET'])
+@conditional(mongo, lambda: ['shops'])
 def get_shops():
-    shops = list(mongo.db.shops.find())
-    return jsonify([serialize_doc(shop) for shop in shops])
-
-@app.route('/api/shops/<shop_id>/products', methods=['GET'])
-def get_shop_products(shop_id):
     try:
-        products = []
+        limit, cursor = page_params(ID_ORDER)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # First, try to find the shop to determine its ID format
-        shop = None
-        try:
-            shop = mongo.db.shops.find_one({'_id': ObjectId(shop_id)})
-        except:
-            # If ObjectId conversion fails, try finding by string
-            shop = mongo.db.shops.find_one({'_id': shop_id})
-
-        if not shop:
-            return jsonify({'error': 'Shop not found'}), 404
+    if limit is None and stream_requested():
+        # Straight from the cursor, bypassing the cache that would hold the whole body
+        return stream_response(mongo.db.shops.find().batch_size(STREAM_BATCH_SIZE))
 
-        # Now try to find products with different shop_id formats
-        # Try ObjectId format first
-        try:
-            products = list(mongo.db.products.find({'shop_id': ObjectId(shop_id)}))
-        except:
-            pass  # Continue to try other formats
+    def load_shops():
+        if limit is None:
+            return json_body(list(mongo.db.shops.find()))
+        shops, next_cursor = paginate(mongo.db.shops, {}, ID_ORDER, limit, cursor)
+        return json_body({'items': shops, 'next_cursor': next_cursor})
 
-        # If no products found, try string format
-        if not products:
-            products = list(mongo.db.products.find({'shop_id': shop_id}))
+    body = catalogue_cache.get_or_load(catalogue_key('shops'), load_shops)
+    return json_response(body)
 
-        # If still no products, try using the shop's actual _id format
-        if not products:
-            products = list(mongo.db.products.find({'shop_id': str(shop['_id'])}))
+@app.route('/api/shops/<shop_id>/products', methods=['GET'])
+@conditional(mongo, lambda shop_id: ['products', f'products:{shop_id}'])
+def get_shop_products(shop_id):
+    try:
+        limit, cursor = page_params(ID_ORDER)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def load_products():
+        # Shops and products may store the id as ObjectId or string,
+        # so match both formats in one query each
+        shop = mongo.db.shops.find_one({'_id': id_filter([shop_id])}, {'_id': 1})
+        if not shop:
+            return None
 
-        # One more try: if shop was found by ObjectId, try string version of that ObjectId
-        if not products and '_id' in shop:
-            products = list(mongo.db.products.find({'shop_id': str(shop['_id'])}))
+        query = {'shop_id': id_filter([shop_id, shop['_id']])}
+        if limit is None:
+            return json_body(list(mongo.db.products.find(query)))
+        products, next_cursor = paginate(mongo.db.products, query, ID_ORDER, limit, cursor)
+        return json_body({'items': products, 'next_cursor': next_cursor})
 
-        return jsonify([serialize_doc(product) for product in products])
+    try:
+        body = catalogue_cache.get_or_load(
+            catalogue_key('products', f'products:{shop_id}'), load_products
+        )
+        if body is None:
+            return jsonify({'error': 'Shop not found'}), 404
+        return json_response(body)
     except Exception as e:
-        print(f"Error fetching products: {e}")
+        log.error('products.error', 'Error fetching products', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Update the wishlist endpoint to include quantity
 @app.route('/api/wishlist', methods=['POST'])
 def add_to_wishlist():
-    print(f"🔍 Session check - user_id in session: {'user_id' in session}")
-    print(f"🔍 Session contents: {dict(session)}")
+    if logs.DEBUG:
+        log.debug('wishlist.add', 'Adding to wishlist', session=dict(session))
     
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({
             'error': 'Not authenticated', 
             'session_data': dict(session),
@@ -392,100 +464,79 @@ def add_to_wishlist():
         if not product_id:
             return jsonify({'error': 'Product ID is required'}), 400
 
-        user_id = session['user_id']
+        user_id = current_user_id()
 
-        # Find product
-        product = mongo.db.products.find_one({'_id': ObjectId(product_id)})
-        if not product:
+        # Find product (shop lookups are cached per worker)
+        shop_id = product_shop_id(mongo.db, ObjectId(product_id))
+        if shop_id is None:
             return jsonify({'error': 'Product not found'}), 404
 
-        shop_id = product['shop_id']
-
-        # Check if product already exists in wishlist (with or without variant)
-        query = {
-            'user_id': ObjectId(user_id),
-            'product_id': ObjectId(product_id)
-        }
-
-        # If variant exists, include it in the query
-        if variant and variant.get('size'):
-            query['variant.size'] = variant.get('size')
-
-        existing = mongo.db.wishlist.find_one(query)
+        # Insert the item or set its quantity in a single upsert
+        inserted = add_item(mongo.db, ObjectId(user_id), ObjectId(product_id), shop_id, quantity, variant)
 
-        if existing:
-            # Update quantity if product already exists
-            mongo.db.wishlist.update_one(
-                {'_id': existing['_id']},
-                {'$set': {'quantity': quantity}}  # Set to the new quantity
-            )
-            return jsonify({'message': 'Product quantity updated in wishlist'})
-
-        # Add new wishlist entry with specified quantity
-        wishlist_item = {
-            'user_id': ObjectId(user_id),
-            'product_id': ObjectId(product_id),
-            'shop_id': shop_id,
-            'quantity': quantity,
-            'variant': variant,
-            'added_at': datetime.utcnow()
-        }
-        mongo.db.wishlist.insert_one(wishlist_item)
-        return jsonify({'message': 'Product added to wishlist'})
+        return jsonify({
+            'message': 'Product added to wishlist' if inserted else 'Product quantity updated in wishlist',
+            'inserted': inserted
+        })
 
     except Exception as e:
-        print(f"Error in add_to_wishlist: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.error('wishlist.error', 'Error in add_to_wishlist', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/wishlist', methods=['GET'])
 def get_wishlist():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
-    wishlist_items = list(mongo.db.wishlist.find({'user_id': ObjectId(user_id)}))
-
-    product_ids = [ObjectId(item['product_id']) for item in wishlist_items]
-    products = list(mongo.db.products.find({'_id': {'$in': product_ids}}))
-
-    wishlist_with_details = []
-    for item in wishlist_items:
-        product = next((p for p in products if str(p['_id']) == str(item['product_id'])), None)
-        if product:
-            product_data = serialize_doc(product)
-            product_data['quantity'] = item.get('quantity', 1)
-            product_data['variant'] = item.get('variant')  # include variant details
-            product_data['shop_id'] = str(item.get('shop_id', product.get('shop_id', '')))
-            wishlist_with_details.append(product_data)
+    user_id = current_user_id()
+    # Products joined with quantity, variant and shop_id in one round trip
+    wishlist_with_details = wishlist_products(mongo.db, {'user_id': ObjectId(user_id)})
 
     return jsonify(wishlist_with_details)
 
 
 @app.route('/api/wishlist/<product_id>', methods=['DELETE'])
 def remove_from_wishlist(product_id):
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        result = mongo.db.wishlist.delete_one({
+        removed = mongo.db.wishlist.find_one_and_delete({
             'user_id': ObjectId(user_id),
             'product_id': ObjectId(product_id)
-        })
+        }, projection=cart_counts.COUNTED_FIELDS)
 
-        if result.deleted_count > 0:
+        if removed:
+            cart_counts.record(mongo.db, ObjectId(user_id), [removed], -1)
             return jsonify({'message': 'Product removed from wishlist'})
         else:
             return jsonify({'error': 'Product not found in wishlist'}), 404
     except:
         return jsonify({'error': 'Invalid product ID'}), 400
 
+@app.route('/api/wishlist', methods=['DELETE'])
+def remove_many_from_wishlist():
+    """Remove several products at once; body is {"product_ids": [...]}"""
+    if not current_user_id():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    data = request.get_json(silent=True) or {}
+    product_ids = data.get('product_ids')
+    if not isinstance(product_ids, list) or not product_ids:
+        return jsonify({'error': 'product_ids must be a non-empty list'}), 400
+
+    try:
+        deleted_count, results = remove_items(mongo.db, ObjectId(current_user_id()), product_ids)
+        return jsonify({'deleted_count': deleted_count, 'results': results})
+    except Exception as e:
+        log.error('wishlist.error', 'Error removing wishlist items', exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/checkout', methods=['POST'])
 def checkout():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
     data = request.json
@@ -494,54 +545,29 @@ def checkout():
     if not product_ids:
         return jsonify({'error': 'No products selected'}), 400
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        products = list(mongo.db.products.find({'_id': {'$in': [ObjectId(pid) for pid in product_ids]}}))
-
-        # Find shop owner mobile numbers
-        shop_ids = []
-        for product in products:
-            try:
-                # Try to convert to ObjectId first
-                shop_ids.append(ObjectId(product['shop_id']))
-            except:
-                # If it's already a string, use it directly
-                shop_ids.append(product['shop_id'])
-
-        # Remove duplicates
-        shop_ids = list(set(shop_ids))
-
-        # Find shops with both ObjectId and string formats
-        shops = list(mongo.db.shops.find({'_id': {'$in': shop_ids}}))
-
-        shop_owner_mobiles = [shop['owner_mobile'] for shop in shops]
-
-        # Create order
-        order_items = [{'product_id': ObjectId(pid)} for pid in product_ids]
-        order = Order(ObjectId(user_id), order_items)
-        mongo.db.orders.insert_one(order.to_dict())
-
-        # Clear wishlist after checkout
-        mongo.db.wishlist.delete_many({'user_id': ObjectId(user_id)})
-
-        return jsonify({
-            'message': 'Order placed successfully',
-            'shop_owner_mobiles': shop_owner_mobiles
-        })
+        product_ids = [ObjectId(pid) for pid in product_ids]
+        body, status = run_checkout(
+            mongo, ObjectId(user_id),
+            lambda db, session: products_order(db, ObjectId(user_id), product_ids, session),
+            *idempotency()
+        )
+        invalidate_user(user_id)
+        return jsonify(body), status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/user', methods=['GET'])
 def get_user():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
-    user = mongo.db.users.find_one({'_id': ObjectId(user_id)})
+    user = load_current_user(mongo.db)
 
     if user:
-        return jsonify(serialize_doc(user))
+        return jsonify(user)
     else:
         return jsonify({'error': 'User not found'}), 404
 
@@ -551,115 +577,112 @@ def get_shops_batch():
         data = request.json
         shop_ids = data.get('shop_ids', [])
 
-        print(f"Fetching shops for IDs: {shop_ids}")
+        if logs.DEBUG:
+            log.debug('shops.batch', 'Fetching shops', shop_ids=shop_ids)
 
-        # Convert string IDs to ObjectId
-        object_ids = []
-        for shop_id in shop_ids:
-            try:
-                object_ids.append(ObjectId(shop_id))
-            except:
-                # Keep as string if conversion fails
-                object_ids.append(shop_id)
-                print(f"Could not convert to ObjectId: {shop_id}")
-
-        # Try to find shops with both ObjectId and string formats
+        # One round trip for all ids, whichever format they are stored in
+        found = index_by_id(mongo.db.shops.find({'_id': id_filter(shop_ids)}))
+
+        # Keep the order the client asked for
         shops = []
-        for shop_id in object_ids:
-            try:
-                # Try ObjectId first
-                if isinstance(shop_id, ObjectId):
-                    shop = mongo.db.shops.find_one({'_id': shop_id})
-                else:
-                    shop = mongo.db.shops.find_one({'_id': ObjectId(shop_id)})
-
-                if not shop:
-                    # Try string format
-                    shop = mongo.db.shops.find_one({'_id': shop_id})
-
-                if shop:
-                    shops.append(shop)
-                    print(f"Found shop: {shop['name']} (ID: {shop_id})")
-                else:
-                    print(f"Shop not found for ID: {shop_id}")
-            except Exception as e:
-                print(f"Error finding shop {shop_id}: {e}")
-                # Try one more time with string
-                try:
-                    shop = mongo.db.shops.find_one({'_id': str(shop_id)})
-                    if shop:
-                        shops.append(shop)
-                except:
-                    pass
-
-        return jsonify([serialize_doc(shop) for shop in shops])
+        for shop_id in shop_ids:
+            shop = found.get(str(shop_id))
+            if shop:
+                shops.append(shop)
+            else:
+                log.warning('shops.batch_missing', 'Shop not found', shop_id=str(shop_id))
+
+        return jsonify(shops)
     except Exception as e:
-        print(f"Error fetching shops batch: {e}")
+        log.error('shops.error', 'Error fetching shops batch', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/fix-shop-ids', methods=['POST'])
 def fix_shop_ids():
+    """Start the batched shop_id migration; poll /api/migrations/fix-shop-ids for progress"""
     try:
-        # Get all products with string shop_id
-        products_with_string_ids = list(mongo.db.products.find({
-            'shop_id': {'$type': 'string'}
-        }))
-
-        updated_count = 0
-        for product in products_with_string_ids:
-            try:
-                # Convert string shop_id to ObjectId
-                new_shop_id = ObjectId(product['shop_id'])
-
-                # Update the product
-                result = mongo.db.products.update_one(
-                    {'_id': product['_id']},
-                    {'$set': {'shop_id': new_shop_id}}
-                )
-
-                if result.modified_count > 0:
-                    updated_count += 1
-
-            except Exception as e:
-                print(f"Error converting shop_id for product {product['_id']}: {e}")
-                continue
+        data = request.get_json(silent=True) or {}
+        batch_size = data.get('batch_size', migrations.DEFAULT_BATCH_SIZE)
+        if (not isinstance(batch_size, int) or isinstance(batch_size, bool)
+                or not 1 <= batch_size <= migrations.MAX_BATCH_SIZE):
+            return jsonify({'error': f'batch_size must be an integer from 1 to {migrations.MAX_BATCH_SIZE}'}), 400
+
+        if migrations.run_in_background(mongo.db, 'fix-shop-ids', batch_size) is None:
+            return jsonify({
+                'error': 'Shop id migration is already running',
+                'migration': migrations.status(mongo.db, 'fix-shop-ids')
+            }), 409
 
         return jsonify({
-            'message': f'Successfully converted {updated_count} product shop_ids to ObjectId format'
-        })
+            'message': 'Shop id migration started',
+            'status_url': '/api/migrations/fix-shop-ids'
+        }), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/migrations/<name>', methods=['GET'])
+def get_migration_status(name):
+    """Progress and throughput of a data migration"""
+    checkpoint = migrations.status(mongo.db, name)
+    if not checkpoint:
+        return jsonify({'error': 'Migration has not run'}), 404
+    return jsonify(checkpoint)
+
+@app.route('/api/debug/cache', methods=['GET'])
+@metrics.requires_metrics_secret
+def debug_cache():
+    """Hit/miss counters of this worker's catalogue cache"""
+    return jsonify(catalogue_cache.stats())
+
+@app.route('/api/debug/pool', methods=['GET'])
+@metrics.requires_metrics_secret
+def debug_pool():
+    """Connection pool usage and checkout wait times for this worker"""
+    return jsonify(mongo.pool_stats.snapshot())
+
+@app.route('/api/metrics', methods=['GET'])
+@metrics.requires_metrics_secret
+def get_metrics():
+    """Prometheus metrics summed over all workers"""
+    body, content_type = metrics.render()
+    return app.response_class(body, content_type=content_type)
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Folded stacks of a profiled request (needs the X-Profile secret)"""
+    if not profiling.profiling_requested():
+        return jsonify({'error': 'Not authorized'}), 403
+    if not ObjectId.is_valid(profile_id):
+        return jsonify({'error': 'Invalid profile ID'}), 400
+    profile = mongo.db.profiles.find_one({'_id': ObjectId(profile_id)}, {'folded': 1})
+    if not profile:
+        return jsonify({'error': 'Profile not found'}), 404
+    return app.response_class(profile['folded'], mimetype='text/plain')
+
 @app.route('/api/debug/products', methods=['GET'])
+@metrics.requires_metrics_secret
 def debug_products():
     try:
-        # Get all products with their shop information
-        all_products = list(mongo.db.products.find())
-
-        # Get all shops
-        all_shops = list(mongo.db.shops.find())
-
-        # Check for mismatches
-        product_details = []
-        for product in all_products:
-            product_detail = serialize_doc(product)
-
-            # Check if shop_id exists in shops collection
-            try:
-                shop = mongo.db.shops.find_one({'_id': ObjectId(product['shop_id'])})
-                product_detail['shop_exists'] = bool(shop)
-            except:
-                # Try string comparison
-                shop = mongo.db.shops.find_one({'_id': product['shop_id']})
-                product_detail['shop_exists'] = bool(shop)
-
-            product_details.append(product_detail)
-
-        return jsonify({
-            'products_count': len(all_products),
-            'shops_count': len(all_shops),
-            'products': product_details,
-            'shops': [serialize_doc(shop) for shop in all_shops]
+        # Only shop ids are held in memory; products and shops are streamed
+        shop_ids = set(index_by_id(mongo.db.shops.find({}, {'_id': 1})))
+        counts = {'products': 0, 'shops': 0}
+
+        def products():
+            for product in mongo.db.products.find().batch_size(STREAM_BATCH_SIZE):
+                product['shop_exists'] = str(product.get('shop_id')) in shop_ids
+                counts['products'] += 1
+                yield product
+
+        def shops():
+            for shop in mongo.db.shops.find().batch_size(STREAM_BATCH_SIZE):
+                counts['shops'] += 1
+                yield shop
+
+        return stream_response({
+            'products': products(),
+            'shops': shops(),
+            'products_count': lambda: counts['products'],
+            'shops_count': lambda: counts['shops']
         })
 
     except Exception as e:
@@ -669,216 +692,160 @@ def debug_products():
 
 @app.route('/api/wishlist/<product_id>/quantity', methods=['PUT'])
 def update_wishlist_quantity(product_id):
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
     data = request.json
     quantity = data.get('quantity', 1)
 
     try:
         # Update the quantity in wishlist
-        result = mongo.db.wishlist.update_one(
+        quantity = max(1, quantity)  # Ensure quantity is at least 1
+        before = mongo.db.wishlist.find_one_and_update(
             {
                 'user_id': ObjectId(user_id),
                 'product_id': ObjectId(product_id)
             },
-            {'$set': {'quantity': max(1, quantity)}}  # Ensure quantity is at least 1
+            {'$set': {'quantity': quantity}},
+            {'quantity': 1},
+            return_document=ReturnDocument.BEFORE
         )
 
-        if result.modified_count > 0:
+        if before is not None and before.get('quantity') != quantity:
+            cart_counts.apply(mongo.db, ObjectId(user_id),
+                              quantity=quantity - cart_counts.quantity_of(before))
             return jsonify({'message': 'Quantity updated successfully'})
         else:
             return jsonify({'error': 'Product not found in wishlist'}), 404
     except Exception as e:
-        print(f"Error updating quantity: {e}")
+        log.error('wishlist.error', 'Error updating quantity', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Add this endpoint to get wishlist count by shop
 @app.route('/api/wishlist/shop-counts', methods=['GET'])
 def get_wishlist_shop_counts():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        # Aggregate wishlist items by shop
-        pipeline = [
-            {
-                '$match': {
-                    'user_id': ObjectId(user_id)
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$shop_id',
-                    'count': {'$sum': 1}
-                }
-            }
-        ]
-
-        shop_counts = list(mongo.db.wishlist.aggregate(pipeline))
+        # Kept up to date by every wishlist write, keyed by shop id string
+        counters = cart_counts.get_counts(mongo.db, ObjectId(user_id))
+        return jsonify(cart_counts.shop_counts(counters))
+    except Exception as e:
+        log.error('wishlist.error', 'Error getting shop counts', exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
 
-        # Convert ObjectId to string for JSON serialization
-        result = {}
-        for count in shop_counts:
-            result[str(count['_id'])] = count['count']
+@app.route('/api/cart/count', methods=['GET'])
+def get_cart_count():
+    """Navbar badge: number of items in the cart and their total quantity"""
+    if not current_user_id():
+        return jsonify({'error': 'Not authenticated'}), 401
 
-        return jsonify(result)
+    try:
+        counters = cart_counts.get_counts(mongo.db, ObjectId(current_user_id()))
+        return jsonify({'count': counters['items'], 'quantity': counters['quantity']})
     except Exception as e:
-        print(f"Error getting shop counts: {e}")
+        log.error('wishlist.error', 'Error getting cart count', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Add this endpoint to get wishlist items by shop
 @app.route('/api/wishlist/shop/<shop_id>', methods=['GET'])
 def get_wishlist_by_shop(shop_id):
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        wishlist_items = list(mongo.db.wishlist.find({
-            'user_id': ObjectId(user_id),
-            'shop_id': ObjectId(shop_id)
-        }))
-
-        product_ids = [ObjectId(item['product_id']) for item in wishlist_items]
-        products = list(mongo.db.products.find({'_id': {'$in': product_ids}}))
-
         # Combine product details with wishlist quantities
-        wishlist_with_quantities = []
-        for item in wishlist_items:
-            product = next((p for p in products if str(p['_id']) == str(item['product_id'])), None)
-            if product:
-                product_data = serialize_doc(product)
-                product_data['quantity'] = item.get('quantity', 1)
-                wishlist_with_quantities.append(product_data)
+        wishlist_with_quantities = wishlist_products(
+            mongo.db,
+            {'user_id': ObjectId(user_id), 'shop_id': ObjectId(shop_id)},
+            with_cart_fields=False
+        )
 
         return jsonify(wishlist_with_quantities)
     except Exception as e:
-        print(f"Error getting wishlist by shop: {e}")
+        log.error('wishlist.error', 'Error getting wishlist by shop', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Update the checkout_shop endpoint to handle selected products only
 @app.route('/api/checkout/shop/<shop_id>', methods=['POST'])
 def checkout_shop(shop_id):
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
     data = request.json
     product_ids = data.get('product_ids', [])
 
     try:
-        # Get selected wishlist items for this user and shop
-        query = {
-            'user_id': ObjectId(user_id),
-            'shop_id': ObjectId(shop_id)
-        }
-
-        # If specific product IDs are provided, filter by them
-        if product_ids:
-            query['product_id'] = {'$in': [ObjectId(pid) for pid in product_ids]}
-
-        wishlist_items = list(mongo.db.wishlist.find(query))
-
-        if not wishlist_items:
-            return jsonify({'error': 'No items found for this shop'}), 404
-
-        # Get product details
-        product_ids = [item['product_id'] for item in wishlist_items]
-        products = list(mongo.db.products.find({'_id': {'$in': product_ids}}))
-
-        # Create order
-        order_items = []
-        for item in wishlist_items:
-            product = next((p for p in products if p['_id'] == item['product_id']), None)
-            if product:
-                order_items.append({
-                    'product_id': item['product_id'],
-                    'quantity': item.get('quantity', 1),
-                    'price': product['price'],
-                    'name': product['name']
-                })
-
-        # Get shop details
-        shop = mongo.db.shops.find_one({'_id': ObjectId(shop_id)})
-        if not shop:
-            return jsonify({'error': 'Shop not found'}), 404
-
-        # Create order document
-        order = {
-            'user_id': ObjectId(user_id),
-            'shop_id': ObjectId(shop_id),
-            'items': order_items,
-            'total_amount': sum(item['price'] * item['quantity'] for item in order_items),
-            'status': 'pending',
-            'created_at': datetime.utcnow()
-        }
-
-        order_result = mongo.db.orders.insert_one(order)
-
-        # Remove checked out items from wishlist
-        mongo.db.wishlist.delete_many(query)
-
-        return jsonify({
-            'message': 'Order placed successfully',
-            'shop_owner_mobile': shop['owner_mobile'],
-            'shop_name': shop['name'],
-            'order_id': str(order_result.inserted_id),
-            'total_amount': order['total_amount']
-        })
+        shop_id = ObjectId(shop_id)
+        # If specific product IDs are provided, only those are ordered
+        product_ids = [ObjectId(pid) for pid in product_ids]
+        body, status = run_checkout(
+            mongo, ObjectId(user_id),
+            lambda db, session: shop_order(db, ObjectId(user_id), shop_id, product_ids, session),
+            *idempotency()
+        )
+        invalidate_user(user_id)
+        return jsonify(body), status
 
     except Exception as e:
-        print(f"Error during checkout: {e}")
+        log.error('checkout.error', 'Error during checkout', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # Add this endpoint to update multiple quantities at once
 @app.route('/api/wishlist/quantities', methods=['PUT'])
 def update_wishlist_quantities():
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
-    data = request.json
-
-    if not data or not isinstance(data, list):
-        return jsonify({'error': 'Invalid data format'}), 400
+    user_id = current_user_id()
 
+    # The body is decoded element by element and written in bulk batches
+    results = []
     try:
-        for item in data:
-            product_id = item.get('product_id')
-            quantity = item.get('quantity', 1)
-
-            if not product_id:
-                continue
-
-            # Update the quantity in wishlist
-            result = mongo.db.wishlist.update_one(
-                {
-                    'user_id': ObjectId(user_id),
-                    'product_id': ObjectId(product_id)
-                },
-                {'$set': {'quantity': max(1, quantity)}}  # Ensure quantity is at least 1
-            )
-
-        return jsonify({'message': 'Quantities updated successfully'})
+        items = iter_json_array(request.stream)
+        results.extend(update_quantities(mongo.db, ObjectId(user_id), items))
+    except ValueError as e:
+        return jsonify({'error': 'Invalid data format', 'detail': str(e), 'results': results}), 400
     except Exception as e:
-        print(f"Error updating quantities: {e}")
+        log.error('wishlist.error', 'Error updating quantities', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
+    if not results:
+        return jsonify({'error': 'Invalid data format'}), 400
+
+    return jsonify({
+        'message': 'Quantities updated successfully',
+        'modified_count': sum(1 for result in results if result['status'] == 'modified'),
+        'results': results
+    })
+
 # ======================
 # Reviews API
 # ======================
 
 @app.route('/api/reviews/<shop_id>', methods=['GET'])
+@conditional(mongo, lambda shop_id: [f'reviews:{shop_id}'])
 def get_reviews(shop_id):
-    """Get all reviews for a shop"""
+    """Get all reviews for a shop, or one page of them when limit/cursor is given"""
     try:
-        reviews = list(mongo.db.reviews.find({"shop_id": shop_id}))
-        return jsonify([serialize_doc(r) for r in reviews])
+        limit, cursor = page_params(NEWEST_FIRST)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        if limit is None:
+            reviews = list(mongo.db.reviews.find({"shop_id": shop_id}))
+            return jsonify(reviews)
+
+        reviews, next_cursor = paginate(mongo.db.reviews, {"shop_id": shop_id}, NEWEST_FIRST, limit, cursor)
+        return jsonify({'items': reviews, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -886,7 +853,7 @@ def get_reviews(shop_id):
 @app.route('/api/reviews/<shop_id>', methods=['POST'])
 def add_review(shop_id):
     """Add a review for a shop"""
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
     data = request.json
@@ -899,12 +866,13 @@ def add_review(shop_id):
     try:
         review = {
             "shop_id": shop_id,
-            "user_id": session['user_id'],
+            "user_id": current_user_id(),
             "rating": int(rating),
             "comment": comment,
             "created_at": datetime.utcnow()
         }
         result = mongo.db.reviews.insert_one(review)
+        versions.bump(mongo.db, f'reviews:{shop_id}')
         review["_id"] = str(result.inserted_id)
         return jsonify(review), 201
     except Exception as e:
@@ -912,6 +880,7 @@ def add_review(shop_id):
 
 
 @app.route('/api/reviews/<shop_id>/average', methods=['GET'])
+@conditional(mongo, lambda shop_id: [f'reviews:{shop_id}'])
 def get_average_rating(shop_id):
     """Get average rating for a shop"""
     try:
@@ -932,32 +901,29 @@ def get_average_rating(shop_id):
 @app.route('/api/user/delivery-count', methods=['GET'])
 def get_user_delivery_count():
     """Get user's delivery count for free delivery calculation"""
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        # Count ALL orders for this user (not just completed)
-        delivery_count = mongo.db.orders.count_documents({
-            'user_id': ObjectId(user_id)
-            # Remove status filter to count all orders
-        })
+        # ALL orders for this user (not just completed), counted at checkout
+        delivery_count = order_count(mongo.db, ObjectId(user_id))
 
         return jsonify({
             'deliveryCount': delivery_count
         })
     except Exception as e:
-        print(f"Error fetching delivery count: {e}")
+        log.error('users.error', 'Error fetching delivery count', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/user/increment-delivery', methods=['POST'])
 def increment_delivery_count():
     """Increment user's delivery count"""
-    if 'user_id' not in session:
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
         # Increment the delivery_count field in user document
@@ -966,40 +932,60 @@ def increment_delivery_count():
             {'$inc': {'delivery_count': 1}},
             upsert=True  # Create the field if it doesn't exist
         )
+        invalidate_user(user_id)
 
         if result.modified_count > 0 or result.upserted_id is not None:
             return jsonify({'message': 'Delivery count incremented'})
         else:
             return jsonify({'error': 'User not found'}), 404
     except Exception as e:
-        print(f"Error updating delivery count: {e}")
+        log.error('users.error', 'Error updating delivery count', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/user/orders', methods=['GET'])
 def get_user_orders():
-    """Get user's order history"""
-    if 'user_id' not in session:
+    """Get user's order history, paginated when limit/cursor is given"""
+    if not current_user_id():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    user_id = session['user_id']
+    user_id = current_user_id()
 
     try:
-        orders = list(mongo.db.orders.find({
-            'user_id': ObjectId(user_id)
-        }).sort('created_at', -1))  # Most recent first
+        limit, cursor = page_params(NEWEST_FIRST)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Get user's delivery count from orders (fallback)
-        delivery_count = mongo.db.orders.count_documents({
-            'user_id': ObjectId(user_id)
-        })
+    # ?view=summary leaves out each order's items
+    projection = SUMMARY_PROJECTION if request.args.get('view') == 'summary' else None
 
-        return jsonify({
-            'orders': [serialize_doc(order) for order in orders],
+    try:
+        next_cursor = None
+        if limit is None:
+            orders = mongo.db.orders.find({
+                'user_id': ObjectId(user_id)
+            }, projection).sort('created_at', -1).batch_size(STREAM_BATCH_SIZE)  # Most recent first
+            if not stream_requested():
+                orders = list(orders)
+            delivery_count = order_count(mongo.db, ObjectId(user_id))
+        else:
+            # The page and the order counter in one round trip
+            orders, next_cursor, delivery_count = order_history(
+                mongo.db, ObjectId(user_id), NEWEST_FIRST, limit, cursor, projection
+            )
+
+        response = {
+            'orders': orders,
             'deliveryCount': delivery_count,
             'freeDeliveriesLeft': max(0, 2 - delivery_count)
-        })
+        }
+        if limit is not None:
+            response['next_cursor'] = next_cursor
+        elif stream_requested():
+            # orders is still a cursor here
+            return stream_response(response)
+        return jsonify(response)
     except Exception as e:
-        print(f"Error fetching user orders: {e}")
+        log.error('orders.error', 'Error fetching user orders', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 # ======================
@@ -1017,8 +1003,9 @@ def submit_feedback():
             return jsonify({'error': 'Feedback message is required'}), 400
 
         # Identify user if logged in
-        user_id = session.get('user_id')
-        user_mobile = session.get('user_mobile', 'Anonymous')
+        user_id = current_user_id()
+        claims = token_claims()
+        user_mobile = claims['mobile'] if claims else session.get('user_mobile', 'Anonymous')
 
         feedback_entry = {
             'user_id': ObjectId(user_id) if user_id else None,
@@ -1034,26 +1021,31 @@ def submit_feedback():
         }), 201
 
     except Exception as e:
-        print(f"Error saving feedback: {e}")
+        log.error('feedback.error', 'Error saving feedback', exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
         
 @app.before_request
 def make_session_permanent():
+    # Anonymous and token requests have nothing worth a cookie
+    if request.endpoint in PROBE_ENDPOINTS or uses_token() or not session:
+        return
     session.permanent = True
 
 @app.before_request
 def fix_session_cookies():
     """Fix duplicate session cookies issue"""
+    if request.endpoint in PROBE_ENDPOINTS or uses_token():
+        return
     # Debug cookie information
     cookie_count = request.headers.get('Cookie', '').count('session=')
     if cookie_count > 1:
-        print(f"⚠️ Multiple session cookies detected: {cookie_count}")
+        log.warning('session.duplicate_cookies', 'Multiple session cookies detected', count=cookie_count)
         
     # Ensure session consistency
     if 'user_id' in session:
-        # Verify the user_id is valid
+        # Verify the user_id is valid (served from the per-worker user cache)
         try:
-            user = mongo.db.users.find_one({'_id': ObjectId(session['user_id'])})
+            user = load_current_user(mongo.db)
             if not user:
                 session.clear()
         except:
@@ -1062,6 +1054,8 @@ def fix_session_cookies():
 @app.route('/api/cleanup-cookies', methods=['POST'])
 def cleanup_cookies():
     """Clear duplicate cookies and establish clean session"""
+    if uses_token():
+        return jsonify({'message': 'No cookies to clean up'})
     try:
         # Clear all sessions
         session.clear()
@@ -1076,7 +1070,7 @@ def cleanup_cookies():
         
         return response
     except Exception as e:
-        print(f"Cookie cleanup error: {e}")
+        log.error('session.error', 'Cookie cleanup error', exc_info=True)
         return jsonify({'error': 'Cleanup failed'}), 500
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+"""Async (ASGI) entry point serving the same API as app.py.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 4
+
+The cart endpoints, which are the ones that wait on several Mongo round trips,
+run natively on the event loop with PyMongo's async client, so a slow query no
+longer blocks a worker. Every other route is forwarded to the Flask app through
+a WSGI bridge, unchanged; that includes checkout, whose transaction and
+idempotency handling live in checkout.py. Sessions are read from the same
+signed `locally_session` cookie the Flask app writes, so clients can move
+between the two modes freely.
+"""
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from bson import ObjectId
+from itsdangerous import BadSignature
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, mongo, CORS_ORIGINS, CORS_HEADERS, CORS_METHODS
+from auth import user_cache
+from tokens import bearer_token, decode_token
+from wishlist import lookup_pipeline, add_item_upsert, product_shop_cache, remember_shop_id, ADD_ITEM_OPTIONS
+import cart_counts
+import logs
+import metrics
+
+flask_wsgi = WSGIMiddleware(flask_app)
+_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+_session_max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+db = None
+log = logs.get_logger('asgi')
+
+
+@asynccontextmanager
+async def lifespan(_):
+    # Created per worker process, after uvicorn has spawned it
+    global db
+    client = AsyncMongoClient(mongo.uri, event_listeners=mongo.listeners, **mongo.options)
+    db = client.get_default_database()
+    yield
+    await client.close()
+
+
+class Native:
+    """Serves the given methods of a path on the event loop and the rest through Flask"""
+
+    def __init__(self, path, **handlers):
+        # Label metrics with the same rule syntax Flask uses
+        self.route = path.replace('{', '<').replace('}', '>')
+        self.handlers = {method.upper(): handler for method, handler in handlers.items()}
+
+    async def __call__(self, scope, receive, send):
+        handler = self.handlers.get(scope['method'])
+        if handler is None:
+            await flask_wsgi(scope, receive, send)
+            return
+        stats = metrics.start_request(self.route, scope['method'])
+        try:
+            response = await handler(Request(scope, receive))
+            stats.status = response.status_code
+            await response(scope, receive, send)
+        finally:
+            metrics.finish_request(stats)
+
+
+def native(path, **handlers):
+    return Route(path, Native(path, **handlers))
+
+
+def json_response(data, status=200):
+    # Same encoder as the Flask app, so both modes return identical bodies
+    return Response(flask_app.json.dumpb(data), status_code=status, media_type='application/json')
+
+
+def read_session(request):
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    try:
+        return _serializer.loads(cookie, max_age=_session_max_age)
+    except BadSignature:
+        return {}
+
+
+async def current_user(request):
+    """The authenticated user, or None if there is no valid token or session"""
+    token = bearer_token(request.headers.get('authorization'))
+    if token:
+        claims = decode_token(token)
+        # The native routes only need what the signed token already carries
+        return {'_id': ObjectId(claims['sub']), 'mobile': claims['mobile']} if claims else None
+
+    user_id = read_session(request).get('user_id')
+    if not user_id or not ObjectId.is_valid(user_id):
+        return None
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({'_id': ObjectId(user_id)})
+        if user:
+            user_cache.set(user_id, user)
+    return user
+
+
+async def aggregate(collection, pipeline):
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(None)
+
+
+async def count_cart_change(user_id, items=0, quantity=0, shops=None):
+    """cart_counts.apply for the async client"""
+    update = cart_counts.inc_update(items, quantity, shops)
+    if update['$inc'] and (await db.cart_counters.update_one({'_id': user_id}, update)).matched_count == 0:
+        docs = await db.wishlist.find(*cart_counts.counted_items(user_id)).to_list(None)
+        await db.cart_counters.replace_one({'_id': user_id}, cart_counts.counters_doc(user_id, docs), upsert=True)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def clear_session(response):
+    """Expire the session cookie, as session.clear() does in the Flask app"""
+    interface = flask_app.session_interface
+    response.delete_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        path=interface.get_cookie_path(flask_app),
+        domain=interface.get_cookie_domain(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=(interface.get_cookie_samesite(flask_app) or 'lax').lower()
+    )
+    return response
+
+
+async def check_session(request):
+    """Fast session check endpoint"""
+    try:
+        user = await current_user(request)
+    except Exception as e:
+        log.error('session.error', 'Session check failed', exc_info=True)
+        return json_response({'user': None})
+
+    if user:
+        return json_response({'user': {'id': str(user['_id']), 'mobile': user['mobile']}})
+    user_id = read_session(request).get('user_id')
+    if user_id and not bearer_token(request.headers.get('authorization')):
+        # The session names a user that no longer exists
+        log.info('session.unknown_user', 'Session user not found', user_id=user_id)
+        return clear_session(json_response({'user': None}))
+    return json_response({'user': None})
+
+
+async def get_wishlist(request):
+    user = await current_user(request)
+    if not user:
+        return json_response({'error': 'Not authenticated'}, 401)
+
+    products = await aggregate(db.wishlist, lookup_pipeline({'user_id': user['_id']}))
+    return json_response(products)
+
+
+async def get_wishlist_by_shop(request):
+    user = await current_user(request)
+    if not user:
+        return json_response({'error': 'Not authenticated'}, 401)
+
+    try:
+        match = {'user_id': user['_id'], 'shop_id': ObjectId(request.path_params['shop_id'])}
+        products = await aggregate(db.wishlist, lookup_pipeline(match, with_cart_fields=False))
+        return json_response(products)
+    except Exception as e:
+        log.error('wishlist.error', 'Error getting wishlist by shop', exc_info=True)
+        return json_response({'error': 'Internal server error'}, 500)
+
+
+async def add_to_wishlist(request):
+    user = await current_user(request)
+    if not user:
+        return json_response({'error': 'Not authenticated', 'has_user_id': False}, 401)
+
+    try:
+        data = await read_json(request) or {}
+        product_id = data.get('product_id')
+        if not product_id:
+            return json_response({'error': 'Product ID is required'}, 400)
+        product_id = ObjectId(product_id)
+
+        shop_id = product_shop_cache.get(str(product_id))
+        if shop_id is None:
+            product = await db.products.find_one({'_id': product_id}, {'shop_id': 1})
+            if not product:
+                return json_response({'error': 'Product not found'}, 404)
+            shop_id = remember_shop_id(product_id, product['shop_id'])
+
+        quantity = data.get('quantity', 1)
+        query, update, retry = add_item_upsert(user['_id'], product_id, shop_id, quantity, data.get('variant'))
+        try:
+            before = await db.wishlist.find_one_and_update(query, update, upsert=True, **ADD_ITEM_OPTIONS)
+        except DuplicateKeyError:
+            before = await db.wishlist.find_one_and_update(query, retry, **ADD_ITEM_OPTIONS)
+        await count_cart_change(user['_id'], *cart_counts.item_added(shop_id, quantity, before))
+        inserted = before is None
+
+        return json_response({
+            'message': 'Product added to wishlist' if inserted else 'Product quantity updated in wishlist',
+            'inserted': inserted
+        })
+    except Exception as e:
+        log.error('wishlist.error', 'Error in add_to_wishlist', exc_info=True)
+        return json_response({'error': 'Internal server error'}, 500)
+
+
+app = Starlette(
+    routes=[
+        native('/api/check-session', get=check_session),
+        native('/api/wishlist', get=get_wishlist, post=add_to_wishlist),
+        native('/api/wishlist/shop/{shop_id}', get=get_wishlist_by_shop),
+        # Everything else is served by the Flask app
+        Mount('/', app=flask_wsgi),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_credentials=True,
+                   allow_headers=CORS_HEADERS, allow_methods=CORS_METHODS),
+    ],
+    lifespan=lifespan
+)
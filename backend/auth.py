@@ -0,0 +1,110 @@
+import os
+from datetime import datetime, timedelta
+from bson import ObjectId
+from flask import g, request, session
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from cache import TTLCache
+from tokens import bearer_token, decode_token
+
+# Per-worker user cache. Invalidation is local to the worker, so the TTL
+# bounds how long another worker can serve a stale user document.
+user_cache = TTLCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('USER_CACHE_TTL', 60))
+)
+
+# Logins within this many seconds of the recorded lastLogin leave it alone,
+# so a burst of logins by the same user doesn't rewrite the document each time
+LAST_LOGIN_WINDOW = float(os.getenv('LAST_LOGIN_WINDOW', 0))
+
+
+def uses_token():
+    """Whether the request authenticates with a bearer token instead of the cookie"""
+    return bearer_token(request.headers.get('Authorization')) is not None
+
+
+def token_claims():
+    """Claims of the request's bearer token, verified once per request"""
+    if 'token_claims' not in g:
+        token = bearer_token(request.headers.get('Authorization'))
+        g.token_claims = decode_token(token) if token else None
+    return g.token_claims
+
+
+def current_user_id():
+    """Id of the authenticated user from the bearer token or the session"""
+    claims = token_claims()
+    if claims:
+        return claims['sub']
+    if uses_token():
+        # A rejected token never falls back to the cookie
+        return None
+    return session.get('user_id')
+
+
+def load_current_user(db):
+    """Return the current user, loading it at most once per request"""
+    if 'current_user' in g:
+        return g.current_user
+
+    user = None
+    user_id = current_user_id()
+    if user_id:
+        user = user_cache.get(user_id)
+        if user is None:
+            user = db.users.find_one({'_id': ObjectId(user_id)})
+            if user:
+                user_cache.set(user_id, user)
+
+    g.current_user = user
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop a cached user document, e.g. after logout or a user write"""
+    if user_id:
+        user_cache.pop(str(user_id))
+    g.pop('current_user', None)
+
+
+def clean_mobile(mobile):
+    return ''.join(filter(str.isdigit, str(mobile)))
+
+
+def login_update(now, window=LAST_LOGIN_WINDOW):
+    """Pipeline update that creates the user if needed and records the login"""
+    last_login = now
+    if window > 0:
+        last_login = {'$cond': [
+            {'$gt': ['$lastLogin', now - timedelta(seconds=window)]}, '$lastLogin', now
+        ]}
+    return [{'$set': {
+        'createdAt': {'$ifNull': ['$createdAt', now]},
+        'lastLogin': last_login,
+    }}]
+
+
+def login_user(db, mobile):
+    """Find or create the user with this mobile in one round trip
+
+    Returns (user, is_new). The unique index on mobile makes concurrent
+    first logins converge on one document: the losing upsert fails with a
+    duplicate key and is retried as a plain update.
+    """
+    # BSON dates keep milliseconds, so compare at that precision
+    now = datetime.utcnow()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    for attempt in range(2):
+        try:
+            user = db.users.find_one_and_update(
+                {'mobile': mobile}, login_update(now), upsert=True, return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            if attempt:
+                raise
+
+    user_cache.set(str(user['_id']), user)
+    g.pop('current_user', None)
+    return user, user['createdAt'] == now
@@ -0,0 +1,105 @@
+"""Side-by-side benchmark of the sync (gunicorn) and async (uvicorn) servers.
+
+    python -m bench.asgi_vs_wsgi --mongo-uri mongodb://localhost:27017/locally_bench
+
+Both servers are started against the same database with the same number of
+workers. Each virtual user logs in, fills a cart and then repeatedly reads it
+and runs shop checkouts, which are the endpoints the async app serves natively.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import httpx
+from pymongo import MongoClient
+from bench.common import SERVERS, start_server, summarize, session_cookie
+
+def seed(db, shops, products_per_shop):
+    db.shops.delete_many({'bench': True})
+    db.products.delete_many({'bench': True})
+    shop_ids = db.shops.insert_many([
+        {'name': f'Bench shop {i}', 'owner_mobile': '9000000000', 'bench': True} for i in range(shops)
+    ]).inserted_ids
+    products = [
+        {'shop_id': shop_id, 'name': f'Product {j}', 'price': 10 + j, 'bench': True}
+        for shop_id in shop_ids for j in range(products_per_shop)
+    ]
+    db.products.insert_many(products)
+    return [(str(p['shop_id']), str(p['_id'])) for p in products]
+
+
+async def virtual_user(client, user_no, products, iterations, timings):
+    async def timed(name, method, url, **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        timings.setdefault(name, []).append(time.perf_counter() - started)
+        return response
+
+    login = await timed('POST /api/auth/mobile', 'POST', '/api/auth/mobile',
+                        json={'mobile': f'8{user_no:09d}'})
+    headers = {'Cookie': session_cookie(login)}
+
+    for _ in range(iterations):
+        cart = random.sample(products, min(5, len(products)))
+        for _, product_id in cart:
+            await timed('POST /api/wishlist', 'POST', '/api/wishlist', headers=headers,
+                        json={'product_id': product_id, 'quantity': random.randint(1, 3)})
+        await timed('GET /api/check-session', 'GET', '/api/check-session', headers=headers)
+        await timed('GET /api/wishlist', 'GET', '/api/wishlist', headers=headers)
+        for shop_id in {shop_id for shop_id, _ in cart}:
+            await timed('GET /api/wishlist/shop/<id>', 'GET', f'/api/wishlist/shop/{shop_id}', headers=headers)
+            await timed('POST /api/checkout/shop/<id>', 'POST', f'/api/checkout/shop/{shop_id}',
+                        headers=headers, json={})
+
+
+async def run_load(base_url, products, users, iterations):
+    timings = {}
+    limits = httpx.Limits(max_connections=users)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(client, n, products, iterations, timings) for n in range(users)))
+        elapsed = time.perf_counter() - started
+    report = {name: summarize(samples, elapsed) for name, samples in sorted(timings.items())}
+    report['total'] = summarize([s for samples in timings.values() for s in samples], elapsed)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017/locally_bench'))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--iterations', type=int, default=5, help='cart cycles per user')
+    parser.add_argument('--shops', type=int, default=10)
+    parser.add_argument('--products-per-shop', type=int, default=20)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    products = seed(MongoClient(args.mongo_uri).get_default_database(), args.shops, args.products_per_shop)
+    env = {'MONGO_URI': args.mongo_uri, 'SECRET_KEY': 'bench'}
+
+    results = {}
+    for port, (mode, command) in enumerate(SERVERS.items(), start=8801):
+        server = start_server(command(port, args.workers), port, env)
+        try:
+            results[mode] = asyncio.run(run_load(f'http://127.0.0.1:{port}', products, args.users, args.iterations))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'endpoint':32} {'mode':5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name in results['wsgi']:
+        for mode in SERVERS:
+            row = results[mode].get(name)
+            if row:
+                print(f"{name:32} {mode:5} {row['throughput_rps']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
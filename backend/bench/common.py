@@ -0,0 +1,62 @@
+"""Shared helpers for the benchmark scripts in this package."""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Server commands by mode, run from BACKEND_DIR
+SERVERS = {
+    'wsgi': lambda port, workers: ['gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}', '--workers', str(workers)],
+    'asgi': lambda port, workers: ['uvicorn', 'asgi:app', '--port', str(port), '--workers', str(workers)],
+}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """Latency percentiles in milliseconds and throughput for one endpoint"""
+    return {
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 2) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 2) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 2) if samples else None,
+    }
+
+
+def start_server(command, port, env=None):
+    """Start a server process from the backend directory and wait for its port"""
+    process = subprocess.Popen(
+        command, cwd=BACKEND_DIR, env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    sys.exit(f"Server did not start: {' '.join(command)}")
+
+
+def session_cookie(response):
+    """The session cookie from a login response, as a Cookie header value
+
+    The cookie is marked Secure, so HTTP clients won't send it back to a
+    local http:// server on their own.
+    """
+    value = response.cookies.get('locally_session')
+    return f'locally_session={value}' if value else ''
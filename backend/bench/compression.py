@@ -0,0 +1,105 @@
+"""CPU cost versus bytes saved for each response encoding and level.
+
+    python -m bench.compression
+    python -m bench.compression --base-url http://127.0.0.1:5000 --path /api/shops --output runs/compression.json
+
+Without --base-url the payloads are synthetic product and shop listings built
+like bench.seed builds them, at a few sizes. Every gzip level and a range of
+brotli qualities are timed on each payload, so COMPRESS_LEVEL and
+COMPRESS_BROTLI_QUALITY can be picked from the table.
+"""
+import argparse
+import json
+import random
+import time
+import httpx
+import orjson
+from bson import ObjectId
+from compression import BrotliCompressor, GzipCompressor, brotli
+from json_provider import OPTIONS, default
+from models import Product, Shop
+
+
+def _encode(value):
+    # Same bytes the app's JSON provider produces
+    return orjson.dumps(value, default=default, option=OPTIONS)
+
+
+def synthetic_payloads(rng, sizes=(10, 100, 1000)):
+    payloads = {}
+    for count in sizes:
+        products = [{
+            '_id': ObjectId(),
+            **Product(ObjectId(), f'Product {i}', f'Synthetic product {i} ' + 'with a longer description ' * rng.randint(1, 6),
+                      rng.randint(10, 2000), rng.randint(0, 100), f'https://picsum.photos/seed/p{i}/200').to_dict()
+        } for i in range(count)]
+        payloads[f'products x{count}'] = _encode(products)
+    shops = [{
+        '_id': ObjectId(),
+        **Shop(f'Shop {i}', f'9{i:09d}', 'grocery', '09:00', '21:00',
+               f'https://picsum.photos/seed/shop{i}/400', f'{i} Market Street').to_dict()
+    } for i in range(100)]
+    payloads['shops x100'] = _encode(shops)
+    return payloads
+
+
+def fetched_payloads(base_url, paths):
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        # identity, so the server's own compression doesn't get in the way
+        return {path: client.get(path, headers={'Accept-Encoding': 'identity'}).content for path in paths}
+
+
+def encoders():
+    for level in range(1, 10):
+        yield f'gzip-{level}', lambda level=level: GzipCompressor(level)
+    if brotli is not None:
+        for quality in (0, 1, 2, 4, 5, 6, 9, 11):
+            yield f'br-{quality}', lambda quality=quality: BrotliCompressor(quality)
+
+
+def measure(data, make_compressor, repeat):
+    """Mean CPU milliseconds per compression and the compressed size"""
+    started = time.process_time()
+    for _ in range(repeat):
+        compressor = make_compressor()
+        out = compressor.compress(data) + compressor.finish()
+    cpu_ms = (time.process_time() - started) * 1000 / repeat
+    return {
+        'bytes': len(out),
+        'ratio': round(len(out) / len(data), 4) if data else None,
+        'cpu_ms': round(cpu_ms, 3),
+        'mb_per_s': round(len(data) / 1e6 / (cpu_ms / 1000), 1) if cpu_ms else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', help='measure real responses from this server instead')
+    parser.add_argument('--path', action='append', help='endpoint to fetch (repeatable)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    if args.base_url:
+        payloads = fetched_payloads(args.base_url, args.path or ['/api/shops'])
+    else:
+        payloads = synthetic_payloads(random.Random(args.seed))
+
+    results = {}
+    print(f"{'payload':18} {'encoding':9} {'in bytes':>10} {'out bytes':>10} {'ratio':>7} {'cpu ms':>8} {'MB/s':>7}")
+    for name, data in payloads.items():
+        results[name] = {'bytes': len(data)}
+        for encoding, make_compressor in encoders():
+            row = measure(data, make_compressor, args.repeat)
+            results[name][encoding] = row
+            print(f"{name:18} {encoding:9} {len(data):>10} {row['bytes']:>10} {row['ratio']:>7} "
+                  f"{row['cpu_ms']:>8} {row['mb_per_s']!s:>7}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
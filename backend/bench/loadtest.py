@@ -0,0 +1,182 @@
+"""Replay the app's user flows against a server at a fixed concurrency.
+
+    python -m bench.loadtest --seed-data --concurrency 50 --duration 60 --output runs/baseline.json
+    python -m bench.loadtest --base-url http://127.0.0.1:5000 --concurrency 50 --output runs/after.json
+
+Without --base-url a gunicorn (or, with --server asgi, uvicorn) server is
+started against --mongo-uri. --seed-data first rebuilds that database with
+bench.seed. Each virtual user keeps picking a flow by weight until the
+duration runs out:
+
+    browse     list shops, open one, read its reviews and average rating
+    shop       log in, browse, add to the wishlist, view it, check out per shop
+    history    log in, read the order history and delivery count
+
+The JSON report holds p50/p95/p99 latency, throughput and status codes per
+endpoint, plus the run's arguments and git commit so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+from collections import Counter
+from datetime import datetime
+import httpx
+from bench.common import BACKEND_DIR, SERVERS, start_server, summarize, session_cookie
+from bench.seed import add_arguments as add_seed_arguments, seed_from_args, user_mobile
+
+
+def items(response):
+    """The documents of a list response, paginated ({'items': [...]}) or not (older builds)"""
+    if response is None:
+        return []
+    body = response.json()
+    return body['items'] if isinstance(body, dict) else body
+
+
+class VirtualUser:
+    def __init__(self, client, rng, users, timings, statuses):
+        self.client = client
+        self.rng = rng
+        self.users = users
+        self.timings = timings
+        self.statuses = statuses
+        self.headers = {}
+
+    async def request(self, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except httpx.HTTPError as e:
+            self.statuses.setdefault(name, Counter())[type(e).__name__] += 1
+            return None
+        self.timings.setdefault(name, []).append(time.perf_counter() - started)
+        self.statuses.setdefault(name, Counter())[str(response.status_code)] += 1
+        return response if response.is_success else None
+
+    async def login(self):
+        mobile = user_mobile(self.rng.randrange(self.users))
+        response = await self.request('POST /api/auth/mobile', 'POST', '/api/auth/mobile', json={'mobile': mobile})
+        self.headers = {'Cookie': session_cookie(response)} if response else {}
+        await self.request('GET /api/check-session', 'GET', '/api/check-session')
+
+    async def open_shop(self):
+        """Browse to a random shop and return its id and product ids, requesting what the frontend does"""
+        shops = items(await self.request('GET /api/shops', 'GET', '/api/shops'))
+        if not shops:
+            return None, []
+        shop_id = self.rng.choice(shops)['_id']
+        response = await self.request('GET /api/shops/<id>/products', 'GET', f'/api/shops/{shop_id}/products')
+        return shop_id, [product['_id'] for product in items(response)]
+
+    async def browse(self):
+        shop_id, _ = await self.open_shop()
+        if shop_id:
+            await self.request('GET /api/reviews/<id>', 'GET', f'/api/reviews/{shop_id}', params={'limit': 10})
+            await self.request('GET /api/reviews/<id>/average', 'GET', f'/api/reviews/{shop_id}/average')
+
+    async def shop(self):
+        await self.login()
+        shop_ids = set()
+        for _ in range(self.rng.randint(1, 3)):
+            shop_id, products = await self.open_shop()
+            for product_id in self.rng.sample(products, min(len(products), self.rng.randint(1, 3))):
+                await self.request('POST /api/wishlist', 'POST', '/api/wishlist',
+                                   json={'product_id': product_id, 'quantity': self.rng.randint(1, 3)})
+                shop_ids.add(shop_id)
+        await self.request('GET /api/wishlist', 'GET', '/api/wishlist')
+        await self.request('GET /api/wishlist/shop-counts', 'GET', '/api/wishlist/shop-counts')
+        for shop_id in shop_ids:
+            await self.request('GET /api/wishlist/shop/<id>', 'GET', f'/api/wishlist/shop/{shop_id}')
+            await self.request('POST /api/checkout/shop/<id>', 'POST', f'/api/checkout/shop/{shop_id}', json={})
+
+    async def history(self):
+        await self.login()
+        await self.request('GET /api/user/orders', 'GET', '/api/user/orders', params={'limit': 10})
+        await self.request('GET /api/user/delivery-count', 'GET', '/api/user/delivery-count')
+
+
+FLOWS = {'browse': 5, 'shop': 3, 'history': 2}
+
+
+async def run_load(base_url, users, concurrency, duration, seed, flows=FLOWS):
+    timings, statuses, flow_counts = {}, {}, Counter()
+    limits = httpx.Limits(max_connections=concurrency)
+    deadline = time.monotonic() + duration
+
+    async def worker(n):
+        user = VirtualUser(client, random.Random(seed * 100003 + n), users, timings, statuses)
+        names, weights = list(flows), list(flows.values())
+        while time.monotonic() < deadline:
+            flow = user.rng.choices(names, weights)[0]
+            user.headers = {}
+            await getattr(user, flow)()
+            flow_counts[flow] += 1
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    report = {name: {**summarize(samples, elapsed), 'statuses': dict(statuses.get(name, {}))}
+              for name, samples in sorted(timings.items())}
+    report['total'] = summarize([s for samples in timings.values() for s in samples], elapsed)
+    return {'elapsed_s': round(elapsed, 2), 'flows': dict(flow_counts), 'endpoints': report}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_seed_arguments(parser)
+    parser.add_argument('--seed-data', action='store_true', help='rebuild the bench database first')
+    parser.add_argument('--base-url', help='load an already running server instead of starting one')
+    parser.add_argument('--server', choices=SERVERS, default='wsgi')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8810)
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load')
+    parser.add_argument('--output', default='loadtest.json', help='where to write the JSON report')
+    args = parser.parse_args()
+
+    if args.seed_data:
+        print(f"Seeded {seed_from_args(args)}")
+
+    started_at = datetime.utcnow()
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        env = {'MONGO_URI': args.mongo_uri, 'SECRET_KEY': 'bench'}
+        server = start_server(SERVERS[args.server](args.port, args.workers), args.port, env)
+        base_url = f'http://127.0.0.1:{args.port}'
+    try:
+        results = asyncio.run(run_load(base_url, args.users, args.concurrency, args.duration, args.seed))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(f"{'endpoint':34} {'requests':>9} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, row in results['endpoints'].items():
+        print(f"{name:34} {row['requests']:>9} {row['throughput_rps']:>8} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'started_at': started_at.isoformat(),
+            'commit': git_commit(),
+            'args': vars(args),
+            **results
+        }, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
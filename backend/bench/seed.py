@@ -0,0 +1,122 @@
+"""Seed a dedicated database with a synthetic marketplace for load tests.
+
+    python -m bench.seed --mongo-uri mongodb://localhost:27017/locally_bench --shops 200
+
+Everything in the target database is replaced, so the database name must
+contain "bench". The same --seed always produces the same data, which keeps
+runs comparable. Users get the mobile numbers 8000000000, 8000000001, ...
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+from indexes import ensure_indexes
+from models import Shop, Product, Review
+
+CATEGORIES = ['grocery', 'bakery', 'pharmacy', 'electronics', 'clothing', 'stationery']
+COLLECTIONS = ['users', 'shops', 'products', 'wishlist', 'orders', 'reviews', 'versions']
+
+
+def user_mobile(n):
+    return f'8{n:09d}'
+
+
+def seed_marketplace(db, shops=50, products_per_shop=40, users=500, wishlist_items=4,
+                     orders_per_user=3, reviews_per_shop=20, seed=42):
+    """Replace the contents of db with a generated marketplace and return its size"""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    for name in COLLECTIONS:
+        db[name].drop()
+    ensure_indexes(db)
+
+    shop_ids = db.shops.insert_many([
+        Shop(f'Shop {i}', f'9{i:09d}', rng.choice(CATEGORIES), '09:00', '21:00',
+             f'https://picsum.photos/seed/shop{i}/400', f'{i} Market Street').to_dict()
+        for i in range(shops)
+    ]).inserted_ids
+
+    products = [
+        Product(shop_id, f'Product {i}-{j}', f'Synthetic product {j} of shop {i}',
+                rng.randint(10, 2000), rng.randint(0, 100), f'https://picsum.photos/seed/p{i}-{j}/200').to_dict()
+        for i, shop_id in enumerate(shop_ids) for j in range(products_per_shop)
+    ]
+    db.products.insert_many(products)
+
+    user_ids = db.users.insert_many([
+        {'mobile': user_mobile(n), 'createdAt': now - timedelta(days=rng.randint(0, 365)), 'lastLogin': now}
+        for n in range(users)
+    ]).inserted_ids
+
+    by_shop = {}
+    for product in products:
+        by_shop.setdefault(product['shop_id'], []).append(product)
+
+    wishlist, orders = [], []
+    for user_id in user_ids:
+        for product in rng.sample(products, min(wishlist_items, len(products))):
+            wishlist.append({
+                'user_id': user_id, 'product_id': product['_id'], 'shop_id': product['shop_id'],
+                'quantity': rng.randint(1, 3), 'variant': None, 'added_at': now
+            })
+        for _ in range(orders_per_user):
+            shop_products = by_shop[rng.choice(shop_ids)]
+            items = [{
+                'product_id': p['_id'], 'quantity': rng.randint(1, 3), 'price': p['price'], 'name': p['name']
+            } for p in rng.sample(shop_products, min(3, len(shop_products)))]
+            orders.append({
+                'user_id': user_id, 'shop_id': shop_products[0]['shop_id'], 'items': items,
+                'total_amount': sum(item['price'] * item['quantity'] for item in items),
+                'status': rng.choice(['pending', 'delivered']),
+                'created_at': now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+            })
+    if wishlist:
+        db.wishlist.insert_many(wishlist)
+    if orders:
+        db.orders.insert_many(orders)
+
+    reviews = [
+        Review(str(shop_id), str(rng.choice(user_ids)), rng.randint(1, 5), 'Synthetic review').to_dict()
+        for shop_id in shop_ids for _ in range(reviews_per_shop)
+    ] if user_ids else []
+    if reviews:
+        db.reviews.insert_many(reviews)
+
+    return {
+        'shops': shops, 'products': len(products), 'users': users, 'wishlist': len(wishlist),
+        'orders': len(orders), 'reviews': len(reviews)
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--mongo-uri', default=os.getenv('BENCH_MONGO_URI', 'mongodb://localhost:27017/locally_bench'))
+    parser.add_argument('--shops', type=int, default=50)
+    parser.add_argument('--products-per-shop', type=int, default=40)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--wishlist-items', type=int, default=4, help='wishlist lines per user')
+    parser.add_argument('--orders-per-user', type=int, default=3)
+    parser.add_argument('--reviews-per-shop', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def seed_from_args(args):
+    db = MongoClient(args.mongo_uri).get_default_database()
+    if 'bench' not in db.name:
+        sys.exit(f"Refusing to replace database {db.name!r}: its name must contain 'bench'")
+    return seed_marketplace(
+        db, shops=args.shops, products_per_shop=args.products_per_shop, users=args.users,
+        wishlist_items=args.wishlist_items, orders_per_user=args.orders_per_user,
+        reviews_per_shop=args.reviews_per_shop, seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    print(seed_from_args(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
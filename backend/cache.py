@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Small thread-safe per-worker cache with a max entry count and TTL"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'expires_at', 'stale_until')
+
+    def __init__(self, value, size, expires_at, stale_until):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class LoadingCache:
+    """Byte-bounded LRU cache with TTL and single-flight loading
+
+    Values are bytes (e.g. encoded response bodies) so their size is exact.
+    When an entry expires only one caller runs the loader; concurrent callers
+    get the expired value for up to `stale_ttl` seconds, or wait for the load.
+    """
+
+    def __init__(self, max_bytes, ttl, stale_ttl=30, load_timeout=10):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.load_timeout = load_timeout
+        self._data = OrderedDict()
+        self._loading = {}
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.stale_hits = self.evictions = 0
+
+    def get_or_load(self, key, loader):
+        """Cached value for key, calling loader() on a miss; None results aren't cached"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._data.get(key)
+            if entry is not None and entry.expires_at > now:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return entry.value
+
+            flight = self._loading.get(key)
+            if flight is not None and entry is not None and entry.stale_until > now:
+                self.stale_hits += 1
+                return entry.value
+
+            self.misses += 1
+            leader = flight is None
+            if leader:
+                flight = self._loading[key] = threading.Event()
+            generation = self._generation
+
+        if not leader:
+            flight.wait(self.load_timeout)
+            with self._lock:
+                entry = self._data.get(key)
+                if entry is not None:
+                    return entry.value
+            # The leader failed or timed out; load without caching
+            return loader()
+
+        try:
+            value = loader()
+            if value is not None:
+                self._store(key, value, generation)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            flight.set()
+
+    def _store(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                # Invalidated while loading; the value may predate the write
+                return
+            now = time.monotonic()
+            self._discard(key)
+            entry = _Entry(value, len(value), now + self.ttl, now + self.ttl + self.stale_ttl)
+            if entry.size > self.max_bytes:
+                return
+            self._data[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def invalidate(self, fragment):
+        """Drop every entry whose key contains fragment"""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if fragment in key]:
+                self._discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,152 @@
+"""Per-user cart counters kept in step with every wishlist write.
+
+The `cart_counters` collection holds one document per user:
+
+    {'_id': user_id, 'items': 3, 'quantity': 5, 'shops': {'<shop_id>': 2, ...}}
+
+so the navbar badge and the per-shop counts are a single _id lookup. Every
+wishlist write $incs the document by exactly what it changed. A user without
+counters (new, or carted before counters existed) gets them rebuilt from the
+wishlist on first use, and `python cart_counts.py rebuild` repairs drift for
+everyone.
+"""
+import sys
+from datetime import datetime
+from pymongo import ReplaceOne
+
+# The wishlist fields the counters are built from
+COUNTED_FIELDS = {'shop_id': 1, 'quantity': 1}
+
+
+def quantity_of(doc):
+    quantity = doc.get('quantity', 1)
+    return quantity if isinstance(quantity, (int, float)) and not isinstance(quantity, bool) else 1
+
+
+def tally(docs, sign=1):
+    """(items, quantity, items per shop) of wishlist docs; sign=-1 for removals"""
+    items, quantity, shops = 0, 0, {}
+    for doc in docs:
+        key = str(doc.get('shop_id'))
+        items += sign
+        quantity += sign * quantity_of(doc)
+        shops[key] = shops.get(key, 0) + sign
+    return items, quantity, shops
+
+
+def item_added(shop_id, quantity, before):
+    """(items, quantity, items per shop) change made by adding an item, given the item as it was"""
+    added = {'shop_id': shop_id, 'quantity': quantity}
+    if before is None:
+        return tally([added])
+    return 0, quantity_of(added) - quantity_of(before), None
+
+
+def inc_update(items=0, quantity=0, shops=None):
+    """$inc update for a change in the counters (empty if nothing changed)"""
+    inc = {'items': items, 'quantity': quantity}
+    inc.update({f'shops.{shop}': count for shop, count in (shops or {}).items()})
+    return {'$inc': {field: value for field, value in inc.items() if value}}
+
+
+def counted_items(user_id):
+    """(filter, projection) of the wishlist items a user's counters are built from"""
+    return {'user_id': user_id}, COUNTED_FIELDS
+
+
+def counters_doc(user_id, docs):
+    items, quantity, shops = tally(docs)
+    return {'_id': user_id, 'items': items, 'quantity': quantity, 'shops': shops,
+            'rebuilt_at': datetime.utcnow()}
+
+
+def rebuild_user(db, user_id, session=None):
+    doc = counters_doc(user_id, db.wishlist.find(*counted_items(user_id), session=session))
+    db.cart_counters.replace_one({'_id': user_id}, doc, upsert=True, session=session)
+    return doc
+
+
+def apply(db, user_id, items=0, quantity=0, shops=None, session=None):
+    """Add a change to a user's counters"""
+    update = inc_update(items, quantity, shops)
+    if not update['$inc']:
+        return
+    if db.cart_counters.update_one({'_id': user_id}, update, session=session).matched_count == 0:
+        # No counters yet: build them from the wishlist, which already has this write
+        rebuild_user(db, user_id, session)
+
+
+def record(db, user_id, docs, sign, session=None):
+    """Count wishlist docs that were just added (sign=1) or removed (sign=-1)"""
+    apply(db, user_id, *tally(docs, sign), session=session)
+
+
+def reset(db, user_id, session=None):
+    """The user's wishlist was emptied"""
+    db.cart_counters.replace_one({'_id': user_id}, counters_doc(user_id, []), upsert=True, session=session)
+
+
+def get_counts(db, user_id):
+    """The user's counters document, building it if it doesn't exist yet"""
+    return db.cart_counters.find_one({'_id': user_id}) or rebuild_user(db, user_id)
+
+
+def shop_counts(counters):
+    # Shops drop to 0 rather than disappearing when their last item goes
+    return {shop: count for shop, count in counters.get('shops', {}).items() if count > 0}
+
+
+def rebuild_all(db, batch_size=1000):
+    """Recount every user's cart from the wishlist; returns the number of users
+
+    Writes racing with the rebuild can leave a user slightly off again; the
+    next run (or that user's next rebuild) corrects it.
+    """
+    started = datetime.utcnow()
+    ops, users = [], 0
+    user_id, docs = None, []
+
+    def flush_user():
+        nonlocal users
+        if user_id is not None:
+            ops.append(ReplaceOne({'_id': user_id}, counters_doc(user_id, docs), upsert=True))
+            users += 1
+
+    for doc in db.wishlist.find({}, {'user_id': 1, **COUNTED_FIELDS}).sort('user_id', 1):
+        if doc.get('user_id') != user_id:
+            flush_user()
+            user_id, docs = doc.get('user_id'), []
+            if len(ops) >= batch_size:
+                db.cart_counters.bulk_write(ops, ordered=False)
+                ops = []
+        docs.append(doc)
+    flush_user()
+    if ops:
+        db.cart_counters.bulk_write(ops, ordered=False)
+
+    # Users whose cart is now empty; they are rebuilt on their next read
+    db.cart_counters.delete_many({'rebuilt_at': {'$lt': started}})
+    return users
+
+
+def main(argv):
+    from bson import ObjectId
+    from dotenv import load_dotenv
+    from db import Mongo
+
+    if len(argv) < 2 or argv[1] != 'rebuild':
+        print("Usage: python cart_counts.py rebuild [USER_ID ...]")
+        return 2
+
+    load_dotenv()
+    db = Mongo().db
+    if len(argv) > 2:
+        for user_id in argv[2:]:
+            print(rebuild_user(db, ObjectId(user_id)))
+    else:
+        print(f"✅ Rebuilt cart counters for {rebuild_all(db)} users")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
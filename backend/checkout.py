@@ -0,0 +1,213 @@
+"""Checkout: turn cart items into an order in one multi-document transaction.
+
+The order insert, the wishlist delete, the cart counters (cart_counts.py) and
+the order counter (orders.py) commit together or not at all. The transaction
+needs a replica set, and a single-node one is enough for local testing:
+
+    mongod --replSet rs0 --dbpath ./data && mongosh --eval 'rs.initiate()'
+
+On a standalone mongod (or CHECKOUT_TRANSACTIONS=0) the same steps run
+without a transaction.
+
+Clients may send an `Idempotency-Key` header. The first request with a key
+claims it. A retry with the same key and body gets the original response
+instead of placing a second order. Keys are kept for a day (TTL index in
+indexes.py):
+
+    IDEMPOTENCY_LEASE   seconds an unfinished checkout holds its key before a
+                        retry may take over (default 60)
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import cart_counts
+from ids import id_filter
+from models import Order
+from lookups import run_lookup
+from orders import record_order
+from wishlist import lookup_pipeline, wishlist_products
+
+IDEMPOTENCY_LEASE = int(os.getenv('IDEMPOTENCY_LEASE', 60))
+MAX_KEY_LENGTH = 255
+
+# Server error code for transactions on a standalone mongod
+_ILLEGAL_OPERATION = 20
+
+_use_transactions = os.getenv('CHECKOUT_TRANSACTIONS', '1') != '0'
+
+
+def shop_lines_pipeline(shop_id, query):
+    """Aggregation returning the shop with the matched cart lines joined to their products"""
+    return [
+        {'$match': {'_id': shop_id}},
+        {'$lookup': {'from': 'wishlist', 'pipeline': lookup_pipeline(query, with_cart_fields=False),
+                     'as': 'lines'}},
+    ]
+
+
+def _shop_and_lines_in_one_query(db, shop_id, query, session):
+    shop = next(db.shops.aggregate(shop_lines_pipeline(shop_id, query), session=session), None)
+    return shop, shop.pop('lines') if shop else []
+
+
+def _shop_and_lines_in_two_queries(db, shop_id, query, session):
+    lines = wishlist_products(db, query, with_cart_fields=False, session=session)
+    return db.shops.find_one({'_id': shop_id}, session=session), lines
+
+
+def _shop_and_lines(db, shop_id, query, session):
+    return run_lookup('checkout_shop_lines',
+                      lambda: _shop_and_lines_in_one_query(db, shop_id, query, session),
+                      lambda: _shop_and_lines_in_two_queries(db, shop_id, query, session),
+                      session)
+
+
+def shop_order(db, user_id, shop_id, product_ids, session=None):
+    """Order the user's cart items from one shop (only `product_ids` if given)"""
+    query = {'user_id': user_id, 'shop_id': shop_id}
+    if product_ids:
+        query['product_id'] = {'$in': product_ids}
+
+    shop, lines = _shop_and_lines(db, shop_id, query, session)
+    if not lines:
+        return {'error': 'No items found for this shop'}, 404
+    if not shop:
+        return {'error': 'Shop not found'}, 404
+
+    order_items = [{
+        'product_id': line['_id'],
+        'quantity': line['quantity'],
+        'price': line['price'],
+        'name': line['name']
+    } for line in lines]
+    order = {
+        'user_id': user_id,
+        'shop_id': shop_id,
+        'items': order_items,
+        'total_amount': sum(item['price'] * item['quantity'] for item in order_items),
+        'status': 'pending',
+        'created_at': datetime.utcnow()
+    }
+    order_id = db.orders.insert_one(order, session=session).inserted_id
+    record_order(db, user_id, session)
+
+    # Remove checked out items from wishlist
+    db.wishlist.delete_many(query, session=session)
+    cart_counts.record(db, user_id, [{'shop_id': shop_id, 'quantity': line['quantity']} for line in lines], -1,
+                       session=session)
+
+    return {
+        'message': 'Order placed successfully',
+        'shop_owner_mobile': shop['owner_mobile'],
+        'shop_name': shop['name'],
+        'order_id': str(order_id),
+        'total_amount': order['total_amount']
+    }, 200
+
+
+def products_order(db, user_id, product_ids, session=None):
+    """Legacy checkout: order the given products and empty the whole cart"""
+    products = list(db.products.find({'_id': {'$in': product_ids}}, {'shop_id': 1}, session=session))
+    # Find shop owner mobile numbers, matching both id formats
+    shops = db.shops.find({'_id': id_filter(product['shop_id'] for product in products)},
+                          {'owner_mobile': 1}, session=session)
+    shop_owner_mobiles = [shop['owner_mobile'] for shop in shops]
+
+    order = Order(user_id, [{'product_id': pid} for pid in product_ids])
+    db.orders.insert_one(order.to_dict(), session=session)
+    record_order(db, user_id, session)
+
+    # Clear wishlist after checkout
+    db.wishlist.delete_many({'user_id': user_id}, session=session)
+    cart_counts.reset(db, user_id, session)
+
+    return {
+        'message': 'Order placed successfully',
+        'shop_owner_mobiles': shop_owner_mobiles
+    }, 200
+
+
+def _in_transaction(client, place):
+    global _use_transactions
+    if _use_transactions:
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(place)
+        except NotImplementedError:
+            _use_transactions = False
+        except OperationFailure as e:
+            if e.code != _ILLEGAL_OPERATION:
+                raise
+            # Standalone server: nothing was written, run it plainly instead
+            _use_transactions = False
+    return place(None)
+
+
+def request_fingerprint(path, body):
+    """Identifies a request body, so a key reused for a different checkout is refused"""
+    return hashlib.sha256(path.encode() + b'\0' + body).hexdigest()
+
+
+def _claim_key(db, key_id, fingerprint):
+    """None if this request may run, else the response to send instead"""
+    now = datetime.utcnow()
+    try:
+        db.idempotency_keys.insert_one({'_id': key_id, 'fingerprint': fingerprint, 'status': 'pending',
+                                        'created_at': now, 'claimed_at': now})
+        return None
+    except DuplicateKeyError:
+        pass
+
+    doc = db.idempotency_keys.find_one({'_id': key_id})
+    if doc is None:
+        # Expired in between
+        return _claim_key(db, key_id, fingerprint)
+    if doc['fingerprint'] != fingerprint:
+        return {'error': 'Idempotency-Key was already used for a different request'}, 422
+    if doc['status'] == 'done':
+        return doc['response']['body'], doc['response']['status']
+
+    # Still pending: either running right now or it died before finishing
+    taken_over = db.idempotency_keys.update_one(
+        {'_id': key_id, 'status': 'pending', 'claimed_at': {'$lt': now - timedelta(seconds=IDEMPOTENCY_LEASE)}},
+        {'$set': {'claimed_at': now}}
+    )
+    if taken_over.modified_count:
+        return None
+    return {'error': 'A checkout with this Idempotency-Key is still in progress'}, 409
+
+
+def run_checkout(mongo, user_id, place, idempotency_key=None, fingerprint=None):
+    """(body, status) of `place(db, session)`, run once per idempotency key in a transaction"""
+    db = mongo.db
+    if not idempotency_key:
+        return _in_transaction(mongo.cx, lambda session: place(db, session))
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        return {'error': 'Idempotency-Key is too long'}, 400
+
+    key_id = f'{user_id}:{idempotency_key}'
+    replay = _claim_key(db, key_id, fingerprint)
+    if replay is not None:
+        return replay
+
+    def place_and_remember(session):
+        body, status = place(db, session)
+        if status == 200:
+            # Committed with the order, so a replay never misses one that exists
+            db.idempotency_keys.update_one(
+                {'_id': key_id},
+                {'$set': {'status': 'done', 'response': {'body': body, 'status': status}}},
+                session=session
+            )
+        return body, status
+
+    try:
+        body, status = _in_transaction(mongo.cx, place_and_remember)
+    except Exception:
+        db.idempotency_keys.delete_one({'_id': key_id, 'status': 'pending'})
+        raise
+    if status != 200:
+        # Nothing was ordered; let the client fix the request and retry with the key
+        db.idempotency_keys.delete_one({'_id': key_id, 'status': 'pending'})
+    return body, status
@@ -0,0 +1,126 @@
+"""Response compression negotiated from Accept-Encoding.
+
+gzip is always available; brotli (in requirements.txt) is preferred when the
+client accepts it. Without the `brotli` package only gzip is offered. Tunable
+from the environment:
+
+    COMPRESS_MIN_SIZE        smallest body worth compressing, in bytes (default 1024)
+    COMPRESS_LEVEL           gzip level 1-9 (default 6)
+    COMPRESS_BROTLI_QUALITY  brotli quality 0-11 (default 4)
+
+Streamed responses are compressed chunk by chunk, and each chunk is flushed
+so the client still receives data as it is produced.
+"""
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+class GzipCompressor:
+    def __init__(self, level=COMPRESS_LEVEL):
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data):
+        return self._zlib.compress(data)
+
+    def flush(self):
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zlib.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality=COMPRESS_BROTLI_QUALITY):
+        self._brotli = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._brotli.process(data)
+
+    def flush(self):
+        return self._brotli.flush()
+
+    def finish(self):
+        return self._brotli.finish()
+
+
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+
+
+def choose_encoding(accept_encoding, available=COMPRESSORS):
+    """The best encoding the client accepts, or None"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    # Preference order decides ties: br compresses JSON noticeably better
+    for coding in ('br', 'gzip'):
+        if coding not in available:
+            continue
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress_chunks(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """after_request hook compressing the response when it is worth it"""
+    if (request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+        return response
+
+    # Caches must keep the encodings apart even when this one goes out as is
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+
+    compressor = COMPRESSORS[encoding]()
+    if response.is_streamed:
+        # Length unknown up front; streams are the large responses anyway
+        response.response = compress_chunks(response.iter_encoded(), compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    # Registered before the other after_request hooks so that it runs last
+    app.after_request(compress_response)
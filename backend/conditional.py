@@ -0,0 +1,63 @@
+import hashlib
+import os
+import time
+from datetime import datetime
+from functools import wraps
+from flask import make_response, request
+from versions import get_versions
+
+# Shops and products are only edited outside the API (e.g. directly in Atlas),
+# which doesn't bump their stamps. After such an edit run
+#
+#     python versions.py bump shops products products:<shop_id>
+#
+# Until then both validators roll over on this period, which matches the
+# catalogue cache TTL in app.py, so clients are never staler than the cache.
+VALIDATOR_PERIOD = int(float(os.getenv('CONDITIONAL_VALIDATOR_PERIOD', os.getenv('CATALOGUE_CACHE_TTL', 60))))
+
+
+def conditional(mongo, keys):
+    """Serve 304 Not Modified when the version stamps behind a view are unchanged
+
+    `keys` receives the view's URL arguments and returns the version keys the
+    response depends on. The validators are derived from those stamps and the
+    query string, so a matching request is answered without running the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            stamp_keys = keys(**kwargs)
+            stamps = get_versions(mongo.db, stamp_keys)
+
+            period = int(time.time()) // VALIDATOR_PERIOD
+            digest = hashlib.sha1(request.full_path.encode())
+            digest.update(str(period).encode())
+            for key in stamp_keys:
+                digest.update(f'|{key}={stamps[key][0]}'.encode())
+            etag = digest.hexdigest()[:20]
+
+            # Never older than the start of the current period, like the etag
+            modified = [updated for _, updated in stamps.values() if updated]
+            modified.append(datetime.utcfromtimestamp(period * VALIDATOR_PERIOD))
+            last_modified = max(modified).replace(microsecond=0)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and since.replace(tzinfo=None) >= last_modified)
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            # Clients may keep the body but must revalidate before reusing it
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
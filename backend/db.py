@@ -0,0 +1,137 @@
+"""MongoDB connection management.
+
+The client is created on first use in each process, so gunicorn workers never
+inherit a client (and its sockets and monitor threads) from the master. Pool
+tuning is read from the environment:
+
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS
+"""
+import os
+import threading
+import time
+from pymongo import MongoClient, monitoring
+
+DEFAULT_URI = 'mongodb://localhost:27017/locally'
+
+_POOL_SETTINGS = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+}
+
+
+def client_options():
+    """Pool keyword arguments for MongoClient taken from the environment"""
+    return {option: int(os.environ[env]) for env, option in _POOL_SETTINGS.items() if os.getenv(env)}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters for this process, fed by pymongo pool events"""
+
+    def __init__(self, max_pool_size):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.pool_clears = 0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = getattr(event, 'duration', None)
+        if waited is None:
+            waited = time.perf_counter() - getattr(self._local, 'started', time.perf_counter())
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'max_pool_size': self.max_pool_size,
+                'open': self.open,
+                'in_use': self.in_use,
+                'saturation': round(self.in_use / self.max_pool_size, 3) if self.max_pool_size else None,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_ms_avg': round(self.wait_seconds_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                'wait_ms_max': round(self.wait_seconds_max * 1000, 3),
+                'pool_clears': self.pool_clears
+            }
+
+
+class Mongo:
+    """Lazily created, fork-aware MongoClient exposing `.cx` and `.db`"""
+
+    def __init__(self, uri=None):
+        self.uri = uri or os.getenv('MONGO_URI') or DEFAULT_URI
+        self.options = client_options()
+        self.pool_stats = PoolStats(self.options.get('maxPoolSize', 100))
+        self.listeners = [self.pool_stats]
+        self._client = None
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """Register a pymongo event listener for clients created from now on"""
+        self.listeners.append(listener)
+
+    @property
+    def cx(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    # A client inherited across fork is unusable; build a fresh one
+                    self._client = MongoClient(self.uri, event_listeners=self.listeners, **self.options)
+                    self._db = self._client.get_default_database()
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def db(self):
+        self.cx
+        return self._db
@@ -0,0 +1,19 @@
+"""gunicorn settings, picked up automatically when gunicorn starts in this directory"""
+import glob
+import os
+
+# Workers write their metrics here so /api/metrics can add them up (see metrics.py)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/locally-metrics')
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be counted again
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
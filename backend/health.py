@@ -0,0 +1,82 @@
+"""Readiness checks run off the request path.
+
+A daemon thread in each worker pings Mongo every READINESS_INTERVAL seconds
+and keeps the outcome, so /api/ready only reads the last result. A worker is
+ready while its last ping succeeded and is no older than READINESS_MAX_AGE.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+import pymongo
+import logs
+
+READINESS_INTERVAL = float(os.getenv('READINESS_INTERVAL', 5))
+READINESS_MAX_AGE = float(os.getenv('READINESS_MAX_AGE', 3 * READINESS_INTERVAL))
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', 2))
+
+log = logs.get_logger('health')
+
+
+class ReadinessMonitor:
+    """Background Mongo ping with the latest result cached"""
+
+    def __init__(self, mongo, interval=READINESS_INTERVAL, max_age=READINESS_MAX_AGE):
+        self.mongo = mongo
+        self.interval = interval
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._pid = None
+        self.ok = False
+        self.checked_at = None
+        self.ping_ms = None
+        self.last_error = None
+        self.last_error_at = None
+
+    def _ensure_started(self):
+        # Started on first use in each worker; threads don't survive fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    # The first answer shouldn't be "not ready" just because nothing ran yet
+                    self.check()
+                    threading.Thread(target=self._run, name='readiness', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        started = time.perf_counter()
+        try:
+            # Bounded, so an unreachable server reports an error instead of hanging the check
+            with pymongo.timeout(READINESS_TIMEOUT):
+                self.mongo.cx.admin.command('ping')
+        except Exception as e:
+            if self.ok or self.last_error is None:
+                log.warning('health.ping_failed', 'Mongo ping failed', error=str(e))
+            with self._lock:
+                self.ok = False
+                self.last_error = str(e)
+                self.last_error_at = datetime.utcnow()
+                self.checked_at = time.time()
+            return
+        with self._lock:
+            self.ok = True
+            self.ping_ms = round((time.perf_counter() - started) * 1000, 3)
+            self.checked_at = time.time()
+
+    def status(self):
+        self._ensure_started()
+        with self._lock:
+            age = time.time() - self.checked_at if self.checked_at else None
+            return {
+                'ready': self.ok and age is not None and age <= self.max_age,
+                'checked_seconds_ago': round(age, 3) if age is not None else None,
+                'ping_ms': self.ping_ms,
+                'last_error': self.last_error,
+                'last_error_at': self.last_error_at.isoformat() if self.last_error_at else None,
+                'pool': self.mongo.pool_stats.snapshot(),
+            }
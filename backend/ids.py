@@ -0,0 +1,34 @@
+"""Helpers for ids stored as either ObjectId or their hex string.
+
+Older documents reference shops and products by string id while newer ones
+use ObjectId. Instead of querying each format in turn, expand every input
+into both forms and match them with a single $in.
+"""
+from bson import ObjectId
+
+
+def id_variants(value):
+    """Every stored form an id may take: the ObjectId and its hex string"""
+    if isinstance(value, ObjectId):
+        return [value, str(value)]
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return [ObjectId(value), value]
+    return [value]
+
+
+def id_filter(values):
+    """An $in clause matching any stored form of any of the given ids"""
+    candidates = []
+    seen = set()
+    for value in values:
+        for candidate in id_variants(value):
+            key = (type(candidate), candidate)
+            if key not in seen:
+                seen.add(key)
+                candidates.append(candidate)
+    return {'$in': candidates}
+
+
+def index_by_id(docs, field='_id'):
+    """Map str(doc[field]) to doc so lookups ignore the stored id format"""
+    return {str(doc[field]): doc for doc in docs}
@@ -0,0 +1,152 @@
+"""Index manifest for every collection the API queries.
+
+Run `python indexes.py ensure` (or `flask --app app ensure-indexes`) to create
+the indexes, and `python indexes.py verify` against a local mongod to check
+that none of the endpoint queries below falls back to a COLLSCAN.
+
+The ensure step runs before the server starts (start.sh, render.yaml), so it
+gives up on an unreachable Mongo after INDEXES_SERVER_SELECTION_TIMEOUT_MS
+(default 5000) instead of holding up boot for the client's usual timeout.
+"""
+import os
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+INDEXES = {
+    'users': [
+        IndexModel([('mobile', ASCENDING)], name='mobile_unique', unique=True),
+    ],
+    'wishlist': [
+        IndexModel([('user_id', ASCENDING), ('product_id', ASCENDING), ('variant.size', ASCENDING)],
+                   name='user_product_variant_unique', unique=True),
+        IndexModel([('user_id', ASCENDING), ('shop_id', ASCENDING)], name='user_shop'),
+    ],
+    'products': [
+        # Also serves paginated listings, which walk a shop's products in _id order
+        IndexModel([('shop_id', ASCENDING), ('_id', ASCENDING)], name='shop_id_id'),
+    ],
+    'reviews': [
+        IndexModel([('shop_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='shop_created_at_id'),
+    ],
+    'orders': [
+        # _id breaks ties for keyset pagination (see pagination.py)
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='user_created_at_id'),
+    ],
+    'profiles': [
+        # Request profiles (see profiling.py) are only kept for a week
+        IndexModel([('created_at', ASCENDING)], name='created_at_ttl', expireAfterSeconds=7 * 24 * 3600),
+    ],
+    'idempotency_keys': [
+        # Checkout retries (see checkout.py) are recognised for a day
+        IndexModel([('created_at', ASCENDING)], name='created_at_ttl', expireAfterSeconds=24 * 3600),
+    ],
+}
+
+# Representative query shapes issued by the endpoints in app.py
+_sample_id = ObjectId()
+QUERY_SHAPES = [
+    ('mobile_auth', {'find': 'users', 'filter': {'mobile': '9999999999'}}),
+    ('add_to_wishlist', {'find': 'wishlist', 'filter': {'user_id': _sample_id, 'product_id': _sample_id}}),
+    ('get_wishlist', {'find': 'wishlist', 'filter': {'user_id': _sample_id}}),
+    ('get_wishlist_by_shop', {'find': 'wishlist', 'filter': {'user_id': _sample_id, 'shop_id': _sample_id}}),
+    ('get_cart_count', {'find': 'cart_counters', 'filter': {'_id': _sample_id}}),
+    ('rebuild_cart_counters', {'find': 'wishlist', 'filter': {}, 'sort': {'user_id': 1},
+                               'projection': {'user_id': 1, 'shop_id': 1, 'quantity': 1}}),
+    ('get_shop_products', {'find': 'products', 'filter': {'shop_id': _sample_id}}),
+    ('get_shop_products_page', {'find': 'products', 'filter': {'shop_id': _sample_id},
+                                'sort': {'_id': 1}, 'limit': 21}),
+    ('get_reviews', {'find': 'reviews', 'filter': {'shop_id': str(_sample_id)}}),
+    ('get_reviews_page', {'find': 'reviews', 'filter': {'shop_id': str(_sample_id)},
+                          'sort': {'created_at': -1, '_id': -1}, 'limit': 21}),
+    ('get_user_orders', {'find': 'orders', 'filter': {'user_id': _sample_id}, 'sort': {'created_at': -1}}),
+    ('get_user_orders_page', {'find': 'orders', 'filter': {'user_id': _sample_id},
+                              'sort': {'created_at': -1, '_id': -1}, 'limit': 21}),
+    ('get_user_delivery_count', {'find': 'users', 'filter': {'_id': _sample_id}}),
+    ('backfill_order_count', {'count': 'orders', 'query': {'user_id': _sample_id}}),
+]
+
+
+def ensure_indexes(db):
+    """Create every index in the manifest; safe to run repeatedly
+
+    Returns (collection, index name, error) for each index that couldn't be
+    created. Indexes are created one at a time because a multi-index
+    createIndexes is all-or-nothing: duplicate data blocking a unique index
+    would otherwise take the collection's other indexes down with it.
+    """
+    failures = []
+    for collection, models in INDEXES.items():
+        for model in models:
+            name = model.document['name']
+            try:
+                db[collection].create_indexes([model])
+            except ConnectionFailure as e:
+                # No server to talk to; the remaining indexes would fail the same way
+                failures.append((collection, name, str(e)))
+                return failures
+            except PyMongoError as e:
+                failures.append((collection, name, str(e)))
+    return failures
+
+
+def _has_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+def verify_indexes(db):
+    """Explain each endpoint query and return the ones that scan the collection
+
+    Run ensure_indexes first: explain on a missing collection reports EOF
+    rather than the plan the query would get.
+    """
+    collscans = []
+    for endpoint, command in QUERY_SHAPES:
+        explain = db.command('explain', command, verbosity='queryPlanner')
+        if _has_collscan(explain):
+            collscans.append(endpoint)
+    return collscans
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    from db import Mongo
+
+    load_dotenv()
+    mode = argv[1] if len(argv) > 1 else 'ensure'
+    mongo = Mongo()
+
+    if mode == 'ensure':
+        # Read after load_dotenv so .env can set it
+        mongo.options['serverSelectionTimeoutMS'] = int(os.getenv('INDEXES_SERVER_SELECTION_TIMEOUT_MS', 5000))
+        db = mongo.db
+        failures = ensure_indexes(db)
+        for collection, name, error in failures:
+            print(f"⚠️ Could not create index {name} on {collection}: {error}")
+        return 1 if failures and '--strict' in argv else 0
+
+    db = mongo.db
+    if mode == 'verify':
+        ensure_indexes(db)
+        collscans = verify_indexes(db)
+        for endpoint in collscans:
+            print(f"❌ COLLSCAN in query for {endpoint}")
+        if not collscans:
+            print(f"✅ All {len(QUERY_SHAPES)} endpoint queries use an index")
+        return 1 if collscans else 0
+
+    print("Usage: python indexes.py [ensure [--strict] | verify]")
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,40 @@
+"""Flask JSON provider backed by orjson.
+
+Mongo documents are returned as they come from the driver: ObjectId (at any
+depth) is encoded as its hex string, Decimal128 as a decimal string, and
+datetimes as ISO 8601 in UTC ("2024-05-01T10:00:00Z"). orjson also parses
+request bodies.
+"""
+import orjson
+from bson import Decimal128, ObjectId
+from flask.json.provider import JSONProvider
+
+# Mongo hands back naive datetimes that are already UTC
+OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+def default(value):
+    # Only called for the types orjson doesn't encode itself
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class ORJSONProvider(JSONProvider):
+    def dumpb(self, obj):
+        """Encode straight to bytes, for response bodies"""
+        return orjson.dumps(obj, default=default, option=OPTIONS)
+
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumpb(obj), mimetype='application/json')
@@ -0,0 +1,135 @@
+"""Structured, non-blocking logging.
+
+Request threads only put records on an in-memory queue; a background thread
+formats them as JSON lines and writes them to stdout, so a slow log drain
+never stalls a request. Configuration comes from the environment:
+
+    LOG_LEVEL           DEBUG, INFO (default), WARNING, ...
+    LOG_SAMPLE_RATES    per-event sampling, e.g. "auth.login=0.1,wishlist.add=0.01"
+    LOG_QUEUE_SIZE      records buffered before new ones are dropped (default 10000)
+
+Debug dumps are wrapped in `if logs.DEBUG:` so that when debug logging is off
+their arguments (session contents, request bodies) are never even built.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LEVEL = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+DEBUG = LEVEL <= logging.DEBUG
+
+
+def _parse_rates(spec):
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        event, _, rate = part.partition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a configured fraction of records for each sampled event"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue without blocking; when the queue is full the record is dropped"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; only render the
+        # traceback here, while the exception is still current
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_root = logging.getLogger('locally')
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+_handler = NonBlockingQueueHandler(queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+_handler.addFilter(SamplingFilter(_parse_rates(os.getenv('LOG_SAMPLE_RATES', ''))))
+_root.addHandler(_handler)
+_root.setLevel(LEVEL)
+_root.propagate = False
+_start_listener()
+atexit.register(_stop_listener)
+# A listener thread doesn't survive fork (e.g. gunicorn --preload)
+os.register_at_fork(after_in_child=_start_listener)
+
+
+class EventLogger:
+    """Logger whose records carry an event name and structured fields"""
+
+    def __init__(self, name):
+        self._logger = _root.getChild(name)
+
+    def _log(self, level, event, msg, exc_info, fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, msg, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+    def debug(self, event, msg, **fields):
+        self._log(logging.DEBUG, event, msg, False, fields)
+
+    def info(self, event, msg, **fields):
+        self._log(logging.INFO, event, msg, False, fields)
+
+    def warning(self, event, msg, **fields):
+        self._log(logging.WARNING, event, msg, False, fields)
+
+    def error(self, event, msg, exc_info=False, **fields):
+        self._log(logging.ERROR, event, msg, exc_info, fields)
+
+
+def get_logger(name):
+    return EventLogger(name)
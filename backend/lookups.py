@@ -0,0 +1,46 @@
+"""Server-side $lookup joins with a multi-query fallback.
+
+The joins in wishlist.py, orders.py and checkout.py each run as one
+aggregation. A server that doesn't support a stage or operator they use
+(mongomock, or a server older than 3.6) fails with an "unsupported" error.
+In that case the join falls back to separate queries, and that decision is
+kept for the life of the process. MONGO_LOOKUP=0 always uses the fallback.
+Any other error (timeouts, network errors, transaction aborts) is raised as
+usual.
+"""
+import os
+from pymongo.errors import OperationFailure
+import logs
+
+LOOKUP_ENABLED = os.getenv('MONGO_LOOKUP', '1') != '0'
+
+# Server error codes meaning "this server can't run that pipeline"
+_UNSUPPORTED_CODES = {
+    168,    # InvalidPipelineOperator
+    4570,   # $lookup given something other than localField/foreignField
+    40324,  # Unrecognized pipeline stage name
+}
+
+_unsupported = set()
+log = logs.get_logger('lookups')
+
+
+def run_lookup(name, aggregate, fallback, session=None):
+    """aggregate() unless the server can't run the `name` join, else fallback()
+
+    Inside a transaction (`session` given) nothing is caught: an error aborts
+    the transaction, so it must reach with_transaction rather than be
+    followed by more reads on the aborted session.
+    """
+    if LOOKUP_ENABLED and name not in _unsupported:
+        if session is not None:
+            return aggregate()
+        try:
+            return aggregate()
+        except (OperationFailure, NotImplementedError) as e:
+            if isinstance(e, OperationFailure) and e.code not in _UNSUPPORTED_CODES:
+                raise
+            _unsupported.add(name)
+            log.warning('lookups.unsupported', 'Server cannot run the join, using separate queries',
+                        join=name, error=str(e))
+    return fallback()
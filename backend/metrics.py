@@ -0,0 +1,172 @@
+"""Prometheus metrics for the API, served at /api/metrics.
+
+Each request is labelled with its route rule (e.g. /api/shops/<shop_id>/products)
+so the series stay bounded. Mongo commands are attributed to the route that
+issued them through a pymongo CommandListener.
+
+gunicorn workers are separate processes, so when PROMETHEUS_MULTIPROC_DIR is set
+every worker writes its samples to files in that directory and the endpoint
+sums them. gunicorn.conf.py sets the directory up and cleans up after workers
+that exit.
+
+/api/metrics and the /api/debug routes answer only requests sent with
+`X-Metrics-Secret: <METRICS_SECRET>` (Prometheus: `http_headers` in the scrape
+config). They are disabled while METRICS_SECRET is unset.
+"""
+import hmac
+import os
+import time
+from contextvars import ContextVar
+from functools import wraps
+from flask import g, jsonify, request
+from pymongo import monitoring
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+
+REQUEST_LATENCY = Histogram(
+    'locally_request_duration_seconds', 'Request latency by route',
+    ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+REQUESTS = Counter(
+    'locally_requests_total', 'Requests by route and status code',
+    ['route', 'method', 'status']
+)
+IN_FLIGHT = Gauge(
+    'locally_requests_in_flight', 'Requests currently being served',
+    ['route'], multiprocess_mode='livesum'
+)
+MONGO_COMMANDS = Counter(
+    'locally_mongo_commands_total', 'Mongo commands by route, command and outcome',
+    ['route', 'command', 'outcome']
+)
+MONGO_LATENCY = Histogram(
+    'locally_mongo_command_duration_seconds', 'Mongo command latency by route',
+    ['route', 'command'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+MONGO_PER_REQUEST = Histogram(
+    'locally_mongo_commands_per_request', 'Mongo commands issued per request',
+    ['route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+)
+
+METRICS_SECRET = os.getenv('METRICS_SECRET', '')
+METRICS_HEADER = 'X-Metrics-Secret'
+
+# Commands issued outside a request (migrations, readiness pings) land here
+BACKGROUND = 'background'
+
+_current = ContextVar('locally_request', default=None)
+
+
+class RequestStats:
+    """What one request has done so far"""
+
+    __slots__ = ('route', 'method', 'started', 'status', 'commands', 'mongo_seconds')
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.status = 500
+        self.commands = 0
+        self.mongo_seconds = 0.0
+
+
+def current_request():
+    """Stats of the request being served by this thread or task, if any"""
+    return _current.get()
+
+
+def start_request(route, method):
+    stats = RequestStats(route, method)
+    _current.set(stats)
+    IN_FLIGHT.labels(route).inc()
+    return stats
+
+
+def finish_request(stats):
+    _current.set(None)
+    IN_FLIGHT.labels(stats.route).dec()
+    REQUEST_LATENCY.labels(stats.route, stats.method).observe(time.perf_counter() - stats.started)
+    REQUESTS.labels(stats.route, stats.method, str(stats.status)).inc()
+    MONGO_PER_REQUEST.labels(stats.route).observe(stats.commands)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Counts and times Mongo commands against the current request's route"""
+
+    def started(self, event):
+        pass
+
+    def _record(self, event, outcome):
+        stats = _current.get()
+        route = stats.route if stats else BACKGROUND
+        seconds = event.duration_micros / 1e6
+        if stats:
+            stats.commands += 1
+            stats.mongo_seconds += seconds
+        MONGO_COMMANDS.labels(route, event.command_name, outcome).inc()
+        MONGO_LATENCY.labels(route, event.command_name).observe(seconds)
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'error')
+
+
+command_metrics = CommandMetrics()
+
+
+def init_app(app, mongo):
+    """Time every request of a Flask app and every command of its Mongo client"""
+    mongo.add_listener(command_metrics)
+
+    @app.before_request
+    def _start_metrics():
+        # Unmatched paths share one label so scanners can't blow up the series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.request_stats = start_request(route, request.method)
+
+    @app.after_request
+    def _record_status(response):
+        stats = g.get('request_stats')
+        if stats:
+            stats.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _finish_metrics(error):
+        stats = g.pop('request_stats', None)
+        if stats:
+            finish_request(stats)
+
+
+def render():
+    """Metrics in the Prometheus text format, summed over all workers"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def metrics_authorized():
+    """True if the request carries the metrics secret (never while it is unset)"""
+    header = request.headers.get(METRICS_HEADER, '')
+    return bool(METRICS_SECRET) and hmac.compare_digest(header.encode(), METRICS_SECRET.encode())
+
+
+def requires_metrics_secret(view):
+    """Refuse a view with 403 unless metrics_authorized()"""
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        if not metrics_authorized():
+            return jsonify({'error': 'Not authorized'}), 403
+        return view(*args, **kwargs)
+    return guarded
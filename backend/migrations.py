@@ -0,0 +1,229 @@
+"""Resumable batched data migrations.
+
+A migration streams the matching documents of one collection in _id order,
+turns each into an update and writes them with unordered bulk_write in
+chunks. Progress is checkpointed in the `migrations` collection after every
+chunk, so an interrupted run resumes after the last _id it wrote.
+
+    python migrations.py run fix-shop-ids [--batch-size 1000]
+    python migrations.py status fix-shop-ids
+"""
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import versions
+
+DEFAULT_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 500))
+MAX_BATCH_SIZE = int(os.getenv('MIGRATION_MAX_BATCH_SIZE', 10000))
+# A running checkpoint not updated for this long is treated as abandoned
+LEASE = timedelta(seconds=int(os.getenv('MIGRATION_LEASE_SECONDS', 300)))
+
+
+class Migration:
+    """A per-document migration: transform(doc) returns an update or None to skip
+
+    `bump_keys` are version stamps to bump whenever a chunk modifies documents.
+    """
+
+    def __init__(self, name, collection, query, transform, projection=None, bump_keys=()):
+        self.name = name
+        self.collection = collection
+        self.query = query
+        self.transform = transform
+        self.projection = projection
+        self.bump_keys = bump_keys
+
+
+MIGRATIONS = {}
+
+
+def register(migration):
+    MIGRATIONS[migration.name] = migration
+    return migration
+
+
+def _shop_id_to_object_id(product):
+    if not ObjectId.is_valid(product['shop_id']):
+        return None
+    return {'$set': {'shop_id': ObjectId(product['shop_id'])}}
+
+
+register(Migration(
+    'fix-shop-ids', 'products',
+    query={'shop_id': {'$type': 'string'}},
+    transform=_shop_id_to_object_id,
+    projection={'shop_id': 1},
+    bump_keys=('products',)
+))
+
+
+class MigrationRunner:
+    def __init__(self, db, migration, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.migration = migration
+        self.batch_size = batch_size
+
+    def claim(self):
+        """Mark the migration as running; returns None if another run holds it"""
+        now = datetime.utcnow()
+        try:
+            checkpoint = self.db.migrations.find_one_and_update(
+                {
+                    '_id': self.migration.name,
+                    '$or': [{'status': {'$ne': 'running'}}, {'updated_at': {'$lt': now - LEASE}}]
+                },
+                {
+                    '$set': {'status': 'running', 'updated_at': now, 'batch_size': self.batch_size},
+                    '$setOnInsert': {'started_at': now}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The checkpoint exists and is held by a live run
+            return None
+
+        if checkpoint.get('finished_at'):
+            # Completed before: start a fresh pass over the collection
+            reset = {'last_id': None, 'processed': 0, 'modified': 0, 'skipped': 0,
+                     'errors': 0, 'started_at': now, 'docs_per_sec': 0}
+            self.db.migrations.update_one(
+                {'_id': self.migration.name},
+                {'$set': reset, '$unset': {'finished_at': '', 'error': ''}}
+            )
+            checkpoint.update(reset)
+        return checkpoint
+
+    def run(self, checkpoint=None):
+        """Run to completion from the last checkpoint; returns the final status
+
+        `checkpoint` is what an earlier claim() returned; without it the run
+        claims the migration itself.
+        """
+        if checkpoint is None:
+            checkpoint = self.claim()
+        if checkpoint is None:
+            return status(self.db, self.migration.name)
+
+        migration = self.migration
+        query = migration.query
+        if checkpoint.get('last_id') is not None:
+            query = {'$and': [migration.query, {'_id': {'$gt': checkpoint['last_id']}}]}
+
+        cursor = (self.db[migration.collection]
+                  .find(query, migration.projection)
+                  .sort('_id', 1)
+                  .batch_size(self.batch_size))
+
+        started = time.monotonic()
+        processed_this_run = 0
+        ops, last_id, skipped = [], None, 0
+        try:
+            for doc in cursor:
+                last_id = doc['_id']
+                update = migration.transform(doc)
+                if update is None:
+                    skipped += 1
+                else:
+                    # Re-check the query so a concurrently fixed document is left alone
+                    ops.append(UpdateOne({'_id': doc['_id'], **migration.query}, update))
+
+                if len(ops) + skipped >= self.batch_size:
+                    processed_this_run += len(ops) + skipped
+                    self._flush(ops, last_id, skipped, processed_this_run, started)
+                    ops, skipped = [], 0
+
+            processed_this_run += len(ops) + skipped
+            self._flush(ops, last_id, skipped, processed_this_run, started, finished=True)
+        except Exception as e:
+            self.db.migrations.update_one(
+                {'_id': migration.name},
+                {'$set': {'status': 'failed', 'error': str(e), 'updated_at': datetime.utcnow()}}
+            )
+            raise
+        finally:
+            cursor.close()
+
+        return status(self.db, migration.name)
+
+    def _flush(self, ops, last_id, skipped, processed_this_run, started, finished=False):
+        modified = errors = 0
+        if ops:
+            try:
+                result = self.db[self.migration.collection].bulk_write(ops, ordered=False)
+                modified = result.modified_count
+            except BulkWriteError as e:
+                modified = e.details.get('nModified', 0)
+                errors = len(e.details.get('writeErrors', []))
+            if modified:
+                versions.bump(self.db, *self.migration.bump_keys)
+
+        now = datetime.utcnow()
+        update = {
+            '$inc': {'processed': len(ops) + skipped, 'modified': modified,
+                     'skipped': skipped, 'errors': errors},
+            '$set': {
+                'updated_at': now,
+                'docs_per_sec': round(processed_this_run / max(time.monotonic() - started, 1e-6), 1)
+            }
+        }
+        if last_id is not None:
+            update['$set']['last_id'] = last_id
+        if finished:
+            update['$set']['status'] = 'completed'
+            update['$set']['finished_at'] = now
+        self.db.migrations.update_one({'_id': self.migration.name}, update)
+
+
+def status(db, name):
+    """The checkpoint document of a migration, or None if it never ran"""
+    checkpoint = db.migrations.find_one({'_id': name})
+    if checkpoint and checkpoint.get('last_id') is not None:
+        checkpoint['last_id'] = str(checkpoint['last_id'])
+    return checkpoint
+
+
+def run_in_background(db, name, batch_size=DEFAULT_BATCH_SIZE):
+    """Claim a migration, then run it on a daemon thread so HTTP callers don't wait for it
+
+    Returns None without starting anything if another run holds the migration.
+    """
+    runner = MigrationRunner(db, MIGRATIONS[name], batch_size)
+    checkpoint = runner.claim()
+    if checkpoint is None:
+        return None
+    thread = threading.Thread(target=runner.run, args=(checkpoint,), name=f'migration-{name}', daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    from db import Mongo
+
+    if len(argv) < 3 or argv[1] not in ('run', 'status') or argv[2] not in MIGRATIONS:
+        print(f"Usage: python migrations.py run|status {{{','.join(MIGRATIONS)}}} [--batch-size N]")
+        return 2
+
+    load_dotenv()
+    db = Mongo().db
+    mode, name = argv[1], argv[2]
+
+    if mode == 'run':
+        batch_size = DEFAULT_BATCH_SIZE
+        if '--batch-size' in argv:
+            batch_size = int(argv[argv.index('--batch-size') + 1])
+        result = MigrationRunner(db, MIGRATIONS[name], batch_size).run()
+    else:
+        result = status(db, name)
+    print(result)
+    return 0 if result and result.get('status') != 'failed' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
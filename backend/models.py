@@ -1,6 +1,8 @@
-from flask_pymongo import PyMongo
 from bson import ObjectId
 from datetime import datetime
+import logs
+
+log = logs.get_logger('models')
 
 class User:
     def __init__(self, mobile):
@@ -121,7 +123,8 @@ class Feedback:
         self.preference = preference
         self.user_mobile = user_mobile  # This should NOT be None
         self.created_at = datetime.utcnow()
-        print(f"🔍 Feedback object created - user_mobile: {self.user_mobile}")  # Debug log
+        if logs.DEBUG:
+            log.debug('feedback.created', 'Feedback object created', user_mobile=self.user_mobile)
 
     def to_dict(self):
         return {
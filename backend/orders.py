@@ -0,0 +1,86 @@
+"""Order history served together with the user's order counter.
+
+Every checkout $incs users.order_count, so the history and delivery-count
+endpoints no longer count the orders collection. A user who ordered before the
+counter existed has it backfilled from their orders the first time it is needed.
+
+A page of history and the counter come back from one aggregation on users, with
+a $lookup into orders that walks the user_created_at_id index (two queries
+where the server can't run it, see lookups.py).
+"""
+from lookups import run_lookup
+from pagination import page_query, split_page
+
+# ?view=summary: the order without its items array
+SUMMARY_PROJECTION = {'items': 0}
+
+
+def order_count_increment(user_id):
+    """(query, update) counting one more order; matches nothing until backfilled"""
+    return {'_id': user_id, 'order_count': {'$exists': True}}, {'$inc': {'order_count': 1}}
+
+
+def backfill_order_count(db, user_id, session=None):
+    count = db.orders.count_documents({'user_id': user_id}, session=session)
+    # $max, so a racing backfill that counted fewer orders can't win
+    db.users.update_one({'_id': user_id}, {'$max': {'order_count': count}}, session=session)
+    return count
+
+
+def record_order(db, user_id, session=None):
+    """Count an order that was just inserted for the user"""
+    query, update = order_count_increment(user_id)
+    if db.users.update_one(query, update, session=session).matched_count == 0:
+        backfill_order_count(db, user_id, session)
+
+
+def order_count(db, user_id):
+    user = db.users.find_one({'_id': user_id}, {'order_count': 1})
+    if user and 'order_count' in user:
+        return user['order_count']
+    return backfill_order_count(db, user_id)
+
+
+def history_pipeline(user_id, sort, limit, cursor=None, projection=None):
+    """Aggregation on users returning the order counter and one page of orders"""
+    orders = [
+        {'$match': page_query({'user_id': user_id}, sort, cursor)},
+        {'$sort': dict(sort)},
+        {'$limit': limit + 1},
+    ]
+    if projection:
+        orders.append({'$project': projection})
+    return [
+        {'$match': {'_id': user_id}},
+        {'$project': {'order_count': 1}},
+        {'$lookup': {'from': 'orders', 'pipeline': orders, 'as': 'orders'}},
+    ]
+
+
+def _history_in_one_query(db, user_id, sort, limit, cursor, projection):
+    result = next(db.users.aggregate(history_pipeline(user_id, sort, limit, cursor, projection)), None)
+    if result is None:
+        # No user document to join from
+        return _history_in_two_queries(db, user_id, sort, limit, cursor, projection)
+    count = result['order_count'] if 'order_count' in result else backfill_order_count(db, user_id)
+    return result['orders'], count
+
+
+def _history_in_two_queries(db, user_id, sort, limit, cursor, projection):
+    query = page_query({'user_id': user_id}, sort, cursor)
+    docs = list(db.orders.find(query, projection).sort(sort).limit(limit + 1))
+    return docs, order_count(db, user_id)
+
+
+def order_history(db, user_id, sort, limit, cursor=None, projection=None):
+    """(orders, next cursor, order count) for one page of a user's orders
+
+    Raises ValueError for a cursor that doesn't fit `sort`.
+    """
+    docs, count = run_lookup(
+        'order_history',
+        lambda: _history_in_one_query(db, user_id, sort, limit, cursor, projection),
+        lambda: _history_in_two_queries(db, user_id, sort, limit, cursor, projection)
+    )
+    orders, next_cursor = split_page(docs, sort, limit)
+    return orders, next_cursor, count
@@ -0,0 +1,91 @@
+"""Opt-in keyset pagination for list endpoints.
+
+Clients send `limit` and, for later pages, the opaque `cursor` returned as
+`next_cursor`. The cursor holds the sort key of the last document served, so
+each page is an index range scan instead of a skip over earlier pages.
+"""
+import base64
+from bson import ObjectId, json_util
+from flask import request
+
+MAX_LIMIT = 100
+
+
+def page_params(sort):
+    """(limit, cursor) from the query string; (None, None) when not paginating
+
+    Raises ValueError for a malformed limit or cursor, including a cursor
+    that wasn't issued for `sort`.
+    """
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        return None, None
+    limit = int(limit) if limit is not None else MAX_LIMIT
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    cursor = decode_cursor(cursor) if cursor else None
+    if cursor is not None and len(cursor) != len(sort):
+        raise ValueError('invalid cursor')
+    return min(limit, MAX_LIMIT), cursor
+
+
+def encode_cursor(doc, sort):
+    values = [doc.get(field) for field, _ in sort]
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+
+def _after(field, value, direction):
+    op = '$lt' if direction < 0 else '$gt'
+    condition = {field: {op: value}}
+    # Range operators only match values of the same BSON type, and legacy
+    # documents mix string and ObjectId ids (strings sort first)
+    if isinstance(value, str) and direction > 0:
+        return {'$or': [condition, {field: {'$type': 'objectId'}}]}
+    if isinstance(value, ObjectId) and direction < 0:
+        return {'$or': [condition, {field: {'$type': 'string'}}]}
+    return condition
+
+
+def keyset_filter(values, sort):
+    """Filter matching documents that sort strictly after `values`"""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {f: values[j] for j, (f, _) in enumerate(sort[:i])}
+        after = _after(field, values[i], direction)
+        clauses.append({'$and': [clause, after]} if clause else after)
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+def page_query(query, sort, cursor=None):
+    """`query` narrowed to the documents after `cursor`"""
+    if cursor is None:
+        return query
+    if len(cursor) != len(sort):
+        raise ValueError('invalid cursor')
+    return {'$and': [query, keyset_filter(cursor, sort)]}
+
+
+def split_page(docs, sort, limit):
+    """(page, next cursor) from up to limit + 1 documents in sort order"""
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1], sort)
+    return docs, None
+
+
+def paginate(collection, query, sort, limit, cursor=None, projection=None):
+    """One page of documents and the cursor for the next page (None at the end)"""
+    query = page_query(query, sort, cursor)
+    docs = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    return split_page(docs, sort, limit)
@@ -0,0 +1,271 @@
+"""Slow-request log and opt-in request profiling.
+
+Every Mongo command a request issues is recorded (up to SLOW_QUERY_MAX_COMMANDS).
+When the request takes longer than SLOW_REQUEST_MS, the commands are logged
+grouped by filter shape, so an N+1 pattern shows up as one shape with a high
+count. The slowest few are also explained (executionStats) in a background
+thread and the plan summary is logged.
+
+A request sent with `X-Profile: <PROFILE_SECRET>` runs under a sampling
+profiler. The folded stacks (flamegraph.pl / speedscope input) are stored in
+the `profiles` collection, and the response carries their id in
+`X-Profile-Id`. Fetch them with GET /api/profiles/<id> and the same header.
+Profiling is disabled while PROFILE_SECRET is unset.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from flask import g, request
+from pymongo import monitoring
+import logs
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 500))
+SLOW_QUERY_MAX_COMMANDS = int(os.getenv('SLOW_QUERY_MAX_COMMANDS', 200))
+SLOW_QUERY_EXPLAIN_LIMIT = int(os.getenv('SLOW_QUERY_EXPLAIN_LIMIT', 3))
+PROFILE_SECRET = os.getenv('PROFILE_SECRET', '')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_HEADER = 'X-Profile'
+
+log = logs.get_logger('profiling')
+
+# Where each command keeps the part worth showing
+_FILTER_FIELDS = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+# Driver and session fields that explain doesn't accept
+_SESSION_FIELDS = {'$db', 'lsid', 'txnNumber', '$clusterTime', '$readPreference',
+                   'autocommit', 'startTransaction', 'readConcern', 'writeConcern'}
+
+_current = ContextVar('locally_slow_log', default=None)
+# One thread is plenty: explains only run for requests that were already slow
+_explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+
+
+def shape(value):
+    """The structure of a filter with its literal values blanked out"""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [shape(value[0])] if value else []
+    return '?'
+
+
+def command_shape(command_name, command):
+    value = command.get(_FILTER_FIELDS.get(command_name, ''))
+    if command_name in ('update', 'delete') and value:
+        # Bulk writes carry one statement per document; their filters share a shape
+        value = value[0].get('q')
+    return shape(value)
+
+
+class CommandLog:
+    """Mongo commands issued by one request"""
+
+    __slots__ = ('started', 'pending', 'commands', 'dropped')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.pending = {}
+        self.commands = []
+        self.dropped = 0
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Keeps each command of the current request alongside its duration"""
+
+    def started(self, event):
+        commands = _current.get()
+        if commands is not None and event.command_name in _FILTER_FIELDS:
+            commands.pending[event.request_id] = (event.database_name, event.command)
+
+    def _finish(self, event, ok):
+        commands = _current.get()
+        if commands is None:
+            return
+        pending = commands.pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        if len(commands.commands) >= SLOW_QUERY_MAX_COMMANDS:
+            commands.dropped += 1
+            return
+        database, command = pending
+        commands.commands.append((event.command_name, database, command, event.duration_micros / 1000, ok))
+
+    def succeeded(self, event):
+        self._finish(event, True)
+
+    def failed(self, event):
+        self._finish(event, False)
+
+
+def summarize(commands):
+    """Group recorded commands by collection and filter shape, slowest first"""
+    groups = {}
+    for name, database, command, ms, ok in commands:
+        collection = command.get(name)
+        key = (name, collection, repr(command_shape(name, command)))
+        group = groups.setdefault(key, {
+            'command': name, 'collection': collection, 'shape': command_shape(name, command),
+            'count': 0, 'total_ms': 0.0, 'errors': 0
+        })
+        group['count'] += 1
+        group['total_ms'] = round(group['total_ms'] + ms, 3)
+        group['errors'] += not ok
+    return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+
+
+def _plan_stages(plan):
+    stages = []
+    while plan:
+        stages.append(plan.get('stage'))
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return '>'.join(stage for stage in stages if stage)
+
+
+def _find_key(doc, key):
+    """First value stored under key anywhere in an explain document"""
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        values = doc.values()
+    elif isinstance(doc, list):
+        values = doc
+    else:
+        return None
+    for value in values:
+        found = _find_key(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def explain_summary(explain):
+    """Plan and documents examined versus returned, from explain(executionStats)"""
+    winning = _find_key(explain, 'winningPlan') or {}
+    stats = _find_key(explain, 'executionStats') or {}
+    return {
+        'plan': _plan_stages(winning.get('queryPlan', winning)),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'returned': stats.get('nReturned'),
+        'execution_ms': stats.get('executionTimeMillis'),
+    }
+
+
+def _explain(mongo, route, name, database, command):
+    try:
+        command = {key: value for key, value in command.items() if key not in _SESSION_FIELDS}
+        explain = mongo.cx[database].command('explain', command, verbosity='executionStats')
+        log.warning('query.slow_explain', 'Explained slow query', route=route, command=name,
+                    collection=command.get(name), shape=command_shape(name, command),
+                    **explain_summary(explain))
+    except Exception:
+        log.error('query.explain_failed', 'Could not explain slow query', exc_info=True,
+                  route=route, command=name)
+
+
+def report_slow(mongo, route, elapsed_ms, commands):
+    groups = summarize(commands.commands)
+    log.warning('request.slow', 'Slow request', route=route, path=request.full_path.rstrip('?'),
+                elapsed_ms=round(elapsed_ms, 1), commands=len(commands.commands) + commands.dropped,
+                mongo_ms=round(sum(group['total_ms'] for group in groups), 3), queries=groups)
+
+    slowest = sorted(commands.commands, key=lambda command: command[3], reverse=True)
+    for name, database, command, ms, ok in slowest[:SLOW_QUERY_EXPLAIN_LIMIT]:
+        _explainer.submit(_explain, mongo, route, name, database, command)
+
+
+class SamplingProfiler:
+    """Samples one thread's stack every interval and counts folded stacks"""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def folded(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def profiling_requested():
+    header = request.headers.get(PROFILE_HEADER, '')
+    return bool(PROFILE_SECRET) and hmac.compare_digest(header.encode(), PROFILE_SECRET.encode())
+
+
+def init_app(app, mongo):
+    """Log slow requests of a Flask app and profile the ones that ask for it"""
+    mongo.add_listener(CommandRecorder())
+
+    @app.before_request
+    def _start_slow_log():
+        g.command_log = CommandLog()
+        _current.set(g.command_log)
+        if profiling_requested():
+            g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+    @app.after_request
+    def _store_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler:
+            profiler.stop()
+            result = mongo.db.profiles.insert_one({
+                'route': request.url_rule.rule if request.url_rule else None,
+                'path': request.full_path.rstrip('?'),
+                'status': response.status_code,
+                'interval_ms': profiler.interval * 1000,
+                'samples': profiler.samples,
+                'folded': profiler.folded(),
+                'created_at': datetime.utcnow()
+            })
+            response.headers['X-Profile-Id'] = str(result.inserted_id)
+        return response
+
+    @app.teardown_request
+    def _finish_slow_log(error):
+        commands = g.pop('command_log', None)
+        _current.set(None)
+        if commands is None:
+            return
+        elapsed_ms = (time.perf_counter() - commands.started) * 1000
+        if elapsed_ms >= SLOW_REQUEST_MS:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            report_slow(mongo, route, elapsed_ms, commands)
@@ -1,2 +1,3 @@
 #!/bin/bash
-gunicorn app:app --bind 0.0.0.0:$PORT --workers 4
\ No newline at end of file
+python indexes.py ensure
+gunicorn app:app --bind 0.0.0.0:$PORT --workers 4
@@ -0,0 +1,101 @@
+import codecs
+import json
+import os
+from collections.abc import Iterator
+
+_decoder = json.JSONDecoder()
+
+# Documents fetched per round trip when a cursor is streamed to the client
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 200))
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield the elements of a JSON array read incrementally from a binary stream
+
+    Only the element being decoded is buffered, so large request bodies are
+    processed without holding the whole payload. Raises ValueError if the body
+    is not a well-formed array.
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = '', 0, False
+    state = 'start'
+
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError('unexpected end of JSON array')
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + utf8.decode(chunk, final=eof), 0
+            continue
+
+        ch = buf[pos]
+        if state == 'start':
+            if ch != '[':
+                raise ValueError('expected a JSON array')
+            pos += 1
+            state = 'first'
+        elif state in ('first', 'sep') and ch == ']':
+            return
+        elif state == 'sep':
+            if ch != ',':
+                raise ValueError('expected , or ] in JSON array')
+            pos += 1
+            state = 'value'
+        else:
+            try:
+                value, end = _decoder.raw_decode(buf, pos)
+                complete = end < len(buf) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError('invalid JSON array element')
+                complete = False
+            if not complete:
+                # The element (or a trailing number) may continue in the next chunk
+                chunk = stream.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + utf8.decode(chunk, final=eof), 0
+                continue
+            pos = end
+            state = 'sep'
+            yield value
+
+
+def _pieces(value, encode):
+    if isinstance(value, dict):
+        yield b'{'
+        for i, (key, item) in enumerate(value.items()):
+            yield (b',' if i else b'') + encode(key) + b':'
+            yield from _pieces(item, encode)
+        yield b'}'
+    elif isinstance(value, Iterator):
+        yield b'['
+        for i, item in enumerate(value):
+            yield (b',' if i else b'') + encode(item)
+        yield b']'
+    elif callable(value):
+        # Worked out only once everything before it has been written
+        yield from _pieces(value(), encode)
+    else:
+        yield encode(value)
+
+
+def iter_json_chunks(value, encode, chunk_size=64 * 1024):
+    """Encode value as JSON in chunks of about chunk_size bytes
+
+    Iterators anywhere in value (cursors, generators) are written out as
+    arrays one element at a time, so only the current chunk is held in
+    memory. Callables are replaced by their result when they are reached.
+    encode turns any other value into JSON bytes.
+    """
+    buf = bytearray()
+    for piece in _pieces(value, encode):
+        buf += piece
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
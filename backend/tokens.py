@@ -0,0 +1,109 @@
+"""Signed bearer tokens, an opt-in alternative to the cookie session.
+
+A client logs in through /api/auth/mobile with {"mode": "token"} and gets a
+short-lived HS256 access token carrying the user id (sub) and mobile. It sends
+`Authorization: Bearer <token>` on later requests and calls /api/auth/mobile
+again for a fresh one before it expires. Identity then costs no Mongo lookup.
+
+Logout revokes a token until its expiry. Revocations are files named after the
+token id in TOKEN_REVOCATION_DIR, which lives in /dev/shm (memory) when
+available, so every worker on the machine sees them.
+"""
+import os
+import tempfile
+import time
+import uuid
+import jwt
+
+ACCESS_TOKEN_TTL = int(os.getenv('ACCESS_TOKEN_TTL', 15 * 60))
+ALGORITHM = 'HS256'
+_SHM = '/dev/shm'
+TOKEN_REVOCATION_DIR = os.getenv('TOKEN_REVOCATION_DIR') or os.path.join(
+    _SHM if os.path.isdir(_SHM) else tempfile.gettempdir(), 'locally-revoked-tokens'
+)
+# Expired revocations are swept after this many revocations in a worker
+_PRUNE_EVERY = 100
+
+
+def _secret():
+    return os.getenv('JWT_SECRET') or os.getenv('SECRET_KEY')
+
+
+def issue_token(user, ttl=ACCESS_TOKEN_TTL):
+    """Access token for a user document, and its lifetime in seconds"""
+    now = int(time.time())
+    claims = {
+        'sub': str(user['_id']),
+        'mobile': user['mobile'],
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + ttl,
+    }
+    return jwt.encode(claims, _secret(), algorithm=ALGORITHM), ttl
+
+
+def bearer_token(authorization):
+    scheme, _, token = (authorization or '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+
+class RevocationList:
+    """Revoked token ids shared by every worker through a directory of files"""
+
+    def __init__(self, directory=TOKEN_REVOCATION_DIR):
+        self.directory = directory
+        self._local = {}
+        self._revocations = 0
+
+    def _path(self, jti):
+        # jti comes from a verified token we issued, so it is plain hex
+        return os.path.join(self.directory, jti)
+
+    def revoke(self, jti, expires_at):
+        self._local[jti] = expires_at
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self._path(jti)
+        open(path, 'a').close()
+        # The file's mtime records when the revocation stops mattering
+        os.utime(path, (expires_at, expires_at))
+        self._revocations += 1
+        if self._revocations % _PRUNE_EVERY == 0:
+            self.prune()
+
+    def is_revoked(self, jti):
+        if jti in self._local:
+            return True
+        return os.path.exists(self._path(jti))
+
+    def prune(self):
+        now = time.time()
+        self._local = {jti: exp for jti, exp in self._local.items() if exp > now}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < now:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+revoked = RevocationList()
+
+
+def decode_token(token):
+    """Claims of a valid, unrevoked token, or None"""
+    try:
+        claims = jwt.decode(token, _secret(), algorithms=[ALGORITHM],
+                            options={'require': ['exp', 'sub', 'jti']})
+    except jwt.InvalidTokenError:
+        return None
+    if not claims['jti'].isalnum() or revoked.is_revoked(claims['jti']):
+        return None
+    return claims
+
+
+def revoke_token(claims):
+    revoked.revoke(claims['jti'], claims['exp'])
@@ -0,0 +1,81 @@
+"""Version stamps for catalogue data, bumped by every write path.
+
+Each stamp is a small document in the `versions` collection, e.g.
+{'_id': 'reviews:<shop_id>', 'version': 7, 'updated_at': ...}. Readers use
+them to build HTTP validators without touching the data itself. Shops and
+products edited outside the API can be invalidated with
+`python versions.py bump shops products`.
+"""
+import os
+import sys
+from pymongo import UpdateOne
+from cache import TTLCache
+
+# Stamps are memoised briefly so repeat polls don't cost a round trip; a
+# bump in another worker becomes visible here within this many seconds.
+_memo = TTLCache(maxsize=4096, ttl=float(os.getenv('VERSION_MEMO_TTL', 2)))
+_listeners = []
+
+
+def get_versions(db, keys):
+    """Map each key to (version, updated_at); unknown keys are (0, None)"""
+    stamps = {}
+    missing = []
+    for key in keys:
+        stamp = _memo.get(key)
+        if stamp is None:
+            missing.append(key)
+        else:
+            stamps[key] = stamp
+
+    if missing:
+        found = {doc['_id']: doc for doc in db.versions.find({'_id': {'$in': missing}})}
+        for key in missing:
+            doc = found.get(key, {})
+            stamp = (doc.get('version', 0), doc.get('updated_at'))
+            _memo.set(key, stamp)
+            stamps[key] = stamp
+    return stamps
+
+
+def bump(db, *keys):
+    """Record a write to the data behind each key"""
+    if not keys:
+        return
+    db.versions.bulk_write([
+        UpdateOne(
+            {'_id': key},
+            {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}},
+            upsert=True
+        )
+        for key in keys
+    ], ordered=False)
+    for key in keys:
+        _memo.pop(key)
+        for listener in _listeners:
+            listener(key)
+
+
+def on_bump(listener):
+    """Call listener(key) whenever this worker bumps a key"""
+    _listeners.append(listener)
+    return listener
+
+
+def main(argv):
+    from dotenv import load_dotenv
+    from db import Mongo
+
+    if len(argv) < 3 or argv[1] != 'bump':
+        print("Usage: python versions.py bump KEY [KEY ...]")
+        return 2
+
+    load_dotenv()
+    db = Mongo().db
+    bump(db, *argv[2:])
+    print(get_versions(db, argv[2:]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,263 @@
+"""Wishlist reads joined with their product documents, and cart writes.
+
+The join runs server-side as one $lookup aggregation, with a dict-indexed
+join in Python as the fallback (see lookups.py).
+"""
+import os
+from datetime import datetime
+from itertools import islice
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import cart_counts
+import versions
+from cache import TTLCache
+from lookups import run_lookup
+
+BULK_BATCH_SIZE = int(os.getenv('WISHLIST_BULK_BATCH_SIZE', 500))
+
+
+def _merged_fields(with_cart_fields):
+    fields = {'quantity': {'$ifNull': ['$quantity', 1]}}
+    if with_cart_fields:
+        fields['variant'] = {'$ifNull': ['$variant', None]}
+        fields['shop_id'] = {'$toString': {'$ifNull': ['$shop_id', {'$ifNull': ['$product.shop_id', '']}]}}
+    return fields
+
+
+def lookup_pipeline(match, with_cart_fields=True):
+    """Aggregation joining the matched wishlist items with their products"""
+    return [
+        {'$match': match},
+        {'$lookup': {
+            'from': 'products',
+            'localField': 'product_id',
+            'foreignField': '_id',
+            'as': 'product'
+        }},
+        # Items whose product was deleted are dropped, as before
+        {'$unwind': '$product'},
+        {'$replaceRoot': {'newRoot': {
+            '$mergeObjects': ['$product', _merged_fields(with_cart_fields)]
+        }}},
+    ]
+
+
+def _lookup(db, match, with_cart_fields, session):
+    return list(db.wishlist.aggregate(lookup_pipeline(match, with_cart_fields), session=session))
+
+
+def _join_in_python(db, match, with_cart_fields, session):
+    items = list(db.wishlist.find(match, session=session))
+    products = {
+        product['_id']: product
+        for product in db.products.find({'_id': {'$in': [item['product_id'] for item in items]}}, session=session)
+    }
+
+    merged = []
+    for item in items:
+        product = products.get(item['product_id'])
+        if product is None:
+            continue
+        doc = dict(product)
+        doc['quantity'] = item.get('quantity', 1)
+        if with_cart_fields:
+            doc['variant'] = item.get('variant')
+            doc['shop_id'] = str(item.get('shop_id', product.get('shop_id', '')))
+        merged.append(doc)
+    return merged
+
+
+def wishlist_products(db, match, with_cart_fields=True, session=None):
+    """Products of the wishlist items matching `match`, merged with the item's quantity
+
+    With `with_cart_fields` each product also carries the item's variant and
+    shop_id (as a string), which is the shape the cart page reads.
+    """
+    return run_lookup('wishlist_products',
+                      lambda: _lookup(db, match, with_cart_fields, session),
+                      lambda: _join_in_python(db, match, with_cart_fields, session),
+                      session)
+
+
+# product_id -> shop_id
+product_shop_cache = TTLCache(
+    maxsize=int(os.getenv('PRODUCT_SHOP_CACHE_SIZE', 20000)),
+    ttl=float(os.getenv('PRODUCT_SHOP_CACHE_TTL', 600))
+)
+
+
+@versions.on_bump
+def _forget_product_shops(key):
+    if key == 'products' or key.startswith('products:'):
+        product_shop_cache.clear()
+
+
+def remember_shop_id(product_id, shop_id):
+    """Cache a product's shop, as an ObjectId even if the product still stores a string"""
+    if isinstance(shop_id, str) and ObjectId.is_valid(shop_id):
+        shop_id = ObjectId(shop_id)
+    product_shop_cache.set(str(product_id), shop_id)
+    return shop_id
+
+
+def product_shop_id(db, product_id):
+    """The shop a product belongs to, or None if the product doesn't exist"""
+    shop_id = product_shop_cache.get(str(product_id))
+    if shop_id is None:
+        product = db.products.find_one({'_id': product_id}, {'shop_id': 1})
+        if not product:
+            return None
+        shop_id = remember_shop_id(product_id, product['shop_id'])
+    return shop_id
+
+
+# find_one_and_update options for the add: the item as it was before the
+# write tells the cart counters what changed
+ADD_ITEM_OPTIONS = {'projection': {'quantity': 1}, 'return_document': ReturnDocument.BEFORE}
+
+
+def add_item_upsert(user_id, product_id, shop_id, quantity, variant=None):
+    """(query, update, retry update) upserting a wishlist item on its unique key
+
+    Items are keyed on (user_id, product_id, variant.size), which is the
+    unique wishlist index in indexes.py. If a concurrent add inserts the item
+    first, the upsert fails with DuplicateKeyError and the retry update is
+    applied to that item instead.
+    """
+    query = {
+        'user_id': user_id,
+        'product_id': product_id,
+        'variant.size': variant.get('size') if variant else None
+    }
+    update = {
+        '$set': {'quantity': quantity},
+        '$setOnInsert': {'shop_id': shop_id, 'variant': variant, 'added_at': datetime.utcnow()}
+    }
+    return query, update, {'$set': update['$set']}
+
+
+def add_item(db, user_id, product_id, shop_id, quantity, variant=None):
+    """Insert or update a wishlist item in one upsert; returns True if it was inserted"""
+    query, update, retry = add_item_upsert(user_id, product_id, shop_id, quantity, variant)
+    try:
+        before = db.wishlist.find_one_and_update(query, update, upsert=True, **ADD_ITEM_OPTIONS)
+    except DuplicateKeyError:
+        before = db.wishlist.find_one_and_update(query, retry, **ADD_ITEM_OPTIONS)
+    cart_counts.apply(db, user_id, *cart_counts.item_added(shop_id, quantity, before))
+    return before is None
+
+
+def _parse_product_id(value):
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else None
+
+
+def _variant_size(item):
+    variant = item.get('variant')
+    return variant.get('size') if isinstance(variant, dict) else None
+
+
+def _update_batch(db, user_id, batch):
+    results = [{'product_id': item.get('product_id') if isinstance(item, dict) else None}
+               for item in batch]
+    wanted = {}
+    for result, item in zip(results, batch):
+        product_id = _parse_product_id(result['product_id'])
+        quantity = item.get('quantity', 1) if isinstance(item, dict) else None
+        if product_id is None:
+            result['status'] = 'invalid_id'
+        elif not isinstance(quantity, int) or isinstance(quantity, bool):
+            result['status'] = 'invalid_quantity'
+        else:
+            if item.get('variant') is not None:
+                result['variant'] = item['variant']
+            # Ensure quantity is at least 1
+            wanted[id(result)] = ((product_id, _variant_size(item)), max(1, quantity))
+
+    # One read tells us which items exist and which would actually change,
+    # keyed like the unique wishlist index
+    current = {}
+    for doc in db.wishlist.find(
+        {'user_id': user_id, 'product_id': {'$in': list({key[0] for key, _ in wanted.values()})}},
+        {'product_id': 1, 'variant.size': 1, 'quantity': 1}
+    ):
+        current[(doc['product_id'], _variant_size(doc))] = doc
+
+    ops, quantity_change = [], 0
+    for result in results:
+        if id(result) not in wanted:
+            continue
+        key, quantity = wanted[id(result)]
+        doc = current.get(key)
+        if doc is None:
+            result['status'] = 'not_found'
+        elif doc.get('quantity', 1) == quantity:
+            result['status'] = 'matched'
+        else:
+            result['status'] = 'modified'
+            # Only if the row still holds what we read, so the delta stays exact
+            ops.append(UpdateOne({'_id': doc['_id'], 'quantity': doc.get('quantity')},
+                                 {'$set': {'quantity': quantity}}))
+            quantity_change += quantity - cart_counts.quantity_of(doc)
+            current[key] = dict(doc, quantity=quantity)
+
+    if ops:
+        modified = db.wishlist.bulk_write(ops, ordered=False).modified_count
+        if modified == len(ops):
+            cart_counts.apply(db, user_id, quantity=quantity_change)
+        else:
+            # A concurrent write got in between; the per-row deltas are unknown
+            cart_counts.rebuild_user(db, user_id)
+    return results
+
+
+def update_quantities(db, user_id, items, batch_size=BULK_BATCH_SIZE):
+    """Apply [{product_id, quantity, variant}, ...] with one bulk_write per batch
+
+    `variant` is optional and picks the item by its size, as in add_item.
+    `items` may be any iterable (e.g. a streamed request body). Yields a
+    result per item with status 'modified', 'matched' (already that
+    quantity), 'not_found', 'invalid_id' or 'invalid_quantity'.
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield from _update_batch(db, user_id, batch)
+
+
+def remove_items(db, user_id, product_ids=None):
+    """Remove the given products from a wishlist (all of them if None) in one delete
+
+    Returns (deleted_count, per-item results) where each result's status is
+    'removed', 'not_found' or 'invalid_id'.
+    """
+    query = {'user_id': user_id}
+    if product_ids is None:
+        deleted = db.wishlist.delete_many(query).deleted_count
+        cart_counts.reset(db, user_id)
+        return deleted, []
+
+    results = [{'product_id': product_id} for product_id in product_ids]
+    parsed = [_parse_product_id(product_id) for product_id in product_ids]
+    query['product_id'] = {'$in': [pid for pid in parsed if pid is not None]}
+
+    removed = list(db.wishlist.find(query, {'product_id': 1, **cart_counts.COUNTED_FIELDS}))
+    present = {doc['product_id'] for doc in removed}
+    for result, product_id in zip(results, parsed):
+        if product_id is None:
+            result['status'] = 'invalid_id'
+        else:
+            result['status'] = 'removed' if product_id in present else 'not_found'
+
+    deleted = 0
+    if present:
+        # Only the items read above, so a concurrent add isn't deleted uncounted
+        deleted = db.wishlist.delete_many({'_id': {'$in': [doc['_id'] for doc in removed]}}).deleted_count
+        if deleted == len(removed):
+            cart_counts.record(db, user_id, removed, -1)
+        else:
+            # Some were removed concurrently and counted there
+            cart_counts.rebuild_user(db, user_id)
+    return deleted, results